@@ -90,6 +90,7 @@ public class jTPCC {
   private static String resultDirName = null;
   private static BufferedWriter summaryCSV = null;
   private static BufferedWriter histogramCSV = null;
+  private static BufferedWriter intervalHistogramCSV = null;
   private static BufferedWriter resultCSV = null;
   private static BufferedWriter runInfoCSV = null;
   public static int runID = 0;
@@ -399,6 +400,19 @@ public class jTPCC {
       }
       log.info("main, writing transaction histogram to " + histogramCSVName);
 
+      // Open the interval_histogram.csv file.
+      String intervalHistogramCSVName =
+          new File(resultDataDir, "interval_histogram.csv").getPath();
+      try {
+        intervalHistogramCSV = new BufferedWriter(new FileWriter(intervalHistogramCSVName));
+        intervalHistogramCSV.write("ttype,second,bucket,numtrans\n");
+      } catch (IOException e) {
+        log.error(e.getMessage());
+        System.exit(1);
+      }
+      log.info("main, writing interval transaction histograms to {}",
+          intervalHistogramCSVName);
+
       // Launch the metric collector script if configured
       if (osCollectorScript != null) {
         try {
@@ -555,6 +569,18 @@ public class jTPCC {
       }
     }
 
+    /*
+     * Close the interval histogram CSV
+     */
+    if (intervalHistogramCSV != null) {
+      try {
+        log.info("interval transaction histogram file finished");
+        intervalHistogramCSV.close();
+      } catch (Exception e) {
+        log.error(e.getMessage());
+      }
+    }
+
     /*
      * Stop the OS stats collector
      */
@@ -592,6 +618,18 @@ public class jTPCC {
     }
   }
 
+  public static void csv_interval_histogram_write(String lines) {
+    if (intervalHistogramCSV != null) {
+      synchronized (result_lock) {
+        try {
+          intervalHistogramCSV.write(lines);
+          intervalHistogramCSV.flush();
+        } catch (Exception e) {
+        }
+      }
+    }
+  }
+
   public static void csv_summary_write(String line) {
     if (summaryCSV != null) {
       try {
@@ -14,6 +14,14 @@ public class jTPCCResult {
   public static final int NUM_BUCKETS = 1000;
   public static final double STATS_CUTOFF = 600.0;
 
+  /*
+   * The per interval histograms written along with result.csv use
+   * coarser buckets. Each of them covers INTERVAL_BUCKET_SIZE buckets
+   * of the run-wide histogram.
+   */
+  public static final int INTERVAL_BUCKET_SIZE = 10;
+  public static final int NUM_INTERVAL_BUCKETS = NUM_BUCKETS / INTERVAL_BUCKET_SIZE;
+
   public jTPCCResult() {
     histCounter = new HistCounter[jTPCCTData.TT_DELIVERY_BG + 1];
     for (int i = 0; i < jTPCCTData.TT_DELIVERY_BG + 1; i++)
@@ -74,6 +82,7 @@ public class jTPCCResult {
     }
 
     rCounter.numTrans++;
+    rCounter.bucket[bucket / INTERVAL_BUCKET_SIZE]++;
     rCounter.sumLatencyMS += latency;
     rCounter.sumDelayMS += delay;
     if (rCounter.numTrans == 1) {
@@ -108,6 +117,21 @@ public class jTPCCResult {
               + resCounter[tt].maxLatencyMS + "," + resCounter[tt].sumDelayMS + ","
               + resCounter[tt].minDelayMS + "," + resCounter[tt].maxDelayMS + "\n");
 
+      /*
+       * The latency histogram of this interval only has lines for the
+       * buckets that are not empty.
+       */
+      StringBuilder sb = new StringBuilder();
+      for (int b = 0; b < NUM_INTERVAL_BUCKETS; b++) {
+        if (resCounter[tt].bucket[b] != 0) {
+          sb.append(jTPCCTData.trans_type_names[tt] + "," + second + "," + b + ","
+              + resCounter[tt].bucket[b] + "\n");
+          resCounter[tt].bucket[b] = 0;
+        }
+      }
+      if (sb.length() > 0)
+        jTPCC.csv_interval_histogram_write(sb.toString());
+
       resCounter[tt].numTrans = 0;
       resCounter[tt].sumLatencyMS = 0;
       resCounter[tt].minLatencyMS = 0;
@@ -161,5 +185,6 @@ public class jTPCCResult {
     public long sumDelayMS = 0;
     public long minDelayMS = 0;
     public long maxDelayMS = 0;
+    public long bucket[] = new long[NUM_INTERVAL_BUCKETS];
   }
 }
@@ -4,7 +4,9 @@
 
 # -*- coding: utf-8
 
-import codecs
+import array
+import collections
+import itertools
 import json
 import os
 import shutil
@@ -54,14 +56,31 @@ class BenchmarkSQL:
         self.status_file = os.path.join(self.data_dir, 'status.json')
         self.status_data = self.load_status()
 
+        # ----
+        # The lock serializes all changes of the job state. Readers
+        # don't take it. They use self.status, an immutable snapshot
+        # of the state that is replaced by publish_status() on every
+        # change. Reading the attribute is atomic.
+        # ----
         self.lock = threading.Lock()
         self.current_job_type = 'IDLE'
         self.current_job = None
         self.current_job_id = 0
         self.current_job_name = ""
-        self.current_job_output = ""
+        self.job_output_spool = os.path.join(self.data_dir, 'job_output.log')
+        self.job_output = JobOutput(self.job_output_spool, 0)
         self.current_job_start = 0.0
-        self.current_job_properties = self.get_properties()
+        self.current_job_properties = self.read_properties()
+        self.live_metrics = None
+        self.status = None
+        self.publish_status()
+
+        # ----
+        # Parsed summary.csv data of finished runs by run_id. An entry
+        # is only used while size and mtime of the file are unchanged.
+        # ----
+        self.txsummary_cache = {}
+        self.txsummary_lock = threading.Lock()
 
     def load_status(self):
         """
@@ -83,30 +102,73 @@ class BenchmarkSQL:
         Save the current status data into the /data/status.json file
         """
         # ----
-        # Caller should hold lock
+        # Caller should hold lock. The file is replaced atomically.
         # ----
-        with open(self.status_file, 'w') as fd:
+        tmp_file = self.status_file + '.tmp'
+        with open(tmp_file, 'w') as fd:
             fd.write(json.dumps(self.status_data, indent = 4))
+        os.replace(tmp_file, self.status_file)
 
-    def get_status(self):
-        self.get_job_type()
-        self.lock.acquire()
-        result = {
+    def publish_status(self, save = False):
+        """
+        Publish a new snapshot of the job state for the readers and,
+        if save is True, write status.json. Caller should hold lock
+        (or be the constructor).
+        """
+        self.status = {
                 'current_job_type': self.current_job_type,
+                'current_job': self.current_job,
                 'current_job_id': self.current_job_id,
                 'current_job_name': self.current_job_name,
-                'current_job_output': self.current_job_output,
                 'current_job_start': self.current_job_start,
                 'current_job_properties': self.current_job_properties,
+                'job_output': self.job_output,
+                'filename': self.status_data['filename'],
+                'results': tuple(
+                    (
+                        entry['run_id'],
+                        entry['name'],
+                        entry['start'],
+                        entry['state'],
+                    ) for entry in self.status_data['results']),
             }
-        self.lock.release()
+        if save:
+            self.save_status()
+
+    def get_status(self, output_offset = 0):
+        """
+        Return the status of the current job. The job output is included
+        from line output_offset on, or left out if that is None.
+        """
+        self.get_job_type()
+        status = self.status
+        job_output = status['job_output']
+        result = {
+                'current_job_type': status['current_job_type'],
+                'current_job_id': status['current_job_id'],
+                'current_job_name': status['current_job_name'],
+                'current_job_generation': job_output.generation,
+                'current_job_start': status['current_job_start'],
+                'current_job_properties': status['current_job_properties'],
+            }
+        if output_offset is None:
+            result['current_job_output_offset'] = len(job_output)
+        else:
+            offset, output = job_output.read(output_offset)
+            result['current_job_output_offset'] = offset
+            result['current_job_output'] = output
         return result
 
     def get_job_type(self):
-        self.lock.acquire()
-        if self.current_job is not None:
-            self.current_job.join(0.0)
-            if not self.current_job.is_alive():
+        # ----
+        # The lock is only needed when the current job has finished
+        # and we have to change the state to IDLE.
+        # ----
+        job = self.status['current_job']
+        if job is not None and not job.is_alive():
+            self.lock.acquire()
+            if self.current_job is job:
+                job.join()
                 for entry in self.status_data['results']:
                     if entry['name'] == self.current_job_name:
                         if entry['state'] == 'RUN':
@@ -116,50 +178,106 @@ class BenchmarkSQL:
                 self.current_job_id = 0
                 self.current_job_type = 'IDLE'
                 self.current_job_name = ""
-        result = self.current_job_type
-        self.save_status()
-        self.lock.release()
-        return result
+                self.publish_status(save = True)
+            self.lock.release()
+        return self.status['current_job_type']
 
     def get_job_runtime(self):
-        self.lock.acquire()
-        if self.current_job is None:
+        status = self.status
+        if status['current_job'] is None:
             result = "--:--:--"
         else:
-            runtime = int(time.time() - self.current_job_start)
+            runtime = int(time.time() - status['current_job_start'])
             result =  "{0:02d}:{1:02d}:{2:02d}".format(
                       int(runtime / 3600), int((runtime / 60) % 60), int(runtime % 60))
-        self.lock.release()
         return result
 
-    def get_job_output(self):
-        self.lock.acquire()
-        result = self.current_job_output
-        self.lock.release()
-        return result
+    def get_job_output(self, offset = 0):
+        """
+        Return the output of the current job from line offset on.
+        """
+        return self.status['job_output'].read(offset)[1]
+
+    def wait_job_output(self, generation, offset, timeout = None):
+        """
+        Wait until the current job has more than offset lines of output
+        (or a new job was started) and return a tuple of the current
+        generation, the new offset and the output since offset. If the
+        job generation is not the one given, all output of the current
+        job is returned.
+        """
+        job_output = self.status['job_output']
+        if generation == job_output.generation:
+            job_output.wait(offset, timeout)
+            # ----
+            # A new job may have been started while we were waiting.
+            # ----
+            job_output = self.status['job_output']
+        if generation != job_output.generation:
+            offset = 0
+        offset, output = job_output.read(offset)
+        return (job_output.generation, offset, output)
 
     def add_job_output(self, output):
-        self.lock.acquire()
-        self.current_job_output += str(output)
-        self.lock.release()
+        self.status['job_output'].append(output)
+
+    def reset_job_output(self):
+        """
+        Start a new, empty job output. Caller should hold lock and
+        publish the status afterwards.
+        """
+        generation = self.job_output.generation + 1
+        self.job_output.close()
+        self.job_output = JobOutput(self.job_output_spool, generation)
+
+    def save_job_output(self, fname):
+        """
+        Make the spool file of the current job output the file fname.
+        """
+        self.status['job_output'].move(fname)
+
+    def get_live_metrics(self, window = 60):
+        """
+        Return rolling metrics of the currently running benchmark,
+        computed from the rows appended to its result.csv since the
+        last call. Returns None if no benchmark is running.
+        """
+        status = self.status
+        if status['current_job_type'] != 'RUN':
+            return None
+        live_metrics = self.live_metrics
+        if live_metrics is None or live_metrics.run_id != status['current_job_id']:
+            live_metrics = LiveMetrics(status['current_job_id'],
+                    os.path.join(self.data_dir, status['current_job_name'], 'data', 'result.csv'))
+            self.live_metrics = live_metrics
+
+        result = live_metrics.get_metrics(window)
+        result['errors'] = status['job_output'].errors
+        return result
 
     def get_job_txsummary(self, run_id):
-        self.lock.acquire()
-        try:
-            fname = os.path.join(self.data_dir, "result_{0:06d}".format(run_id), "data", "summary.csv")
-            result = {}
-            with open(fname, 'r') as fd:
-                csv_reader = csv.DictReader(fd)
-                for row in csv_reader:
-                    result[row['ttype']] = {key: row[key].rstrip('s%') for key in row.keys() if key != 'ttype'}
-        except Exception as e:
-            self.lock.release()
-            raise e
-        self.lock.release()
+        # ----
+        # The file is parsed without holding any lock. Two requests
+        # may parse the same file at once, which is harmless.
+        # ----
+        fname = os.path.join(self.data_dir, "result_{0:06d}".format(run_id), "data", "summary.csv")
+        stat = os.stat(fname)
+        cache_key = (stat.st_size, stat.st_mtime_ns)
+        with self.txsummary_lock:
+            cached = self.txsummary_cache.get(run_id)
+        if cached is not None and cached[0] == cache_key:
+            return cached[1]
+
+        result = {}
+        with open(fname, 'r') as fd:
+            csv_reader = csv.DictReader(fd)
+            for row in csv_reader:
+                result[row['ttype']] = {key: row[key].rstrip('s%') for key in row.keys() if key != 'ttype'}
+        with self.txsummary_lock:
+            self.txsummary_cache[run_id] = (cache_key, result)
         return result
 
-    def get_properties(self):
-        self.lock.acquire()
+    def read_properties(self):
         last_path = os.path.join(self.data_dir, 'last.properties')
         if os.path.exists(last_path):
             with open(last_path, 'r') as fd:
@@ -168,34 +286,43 @@ class BenchmarkSQL:
             sample_path = os.path.join(os.path.dirname(__file__), 'sample.last.properties')
             with open(sample_path, 'r') as fd:
                 result = fd.read()
-        self.current_job_properties = result
-        self.lock.release()
         return result
 
-    def get_results(self):
+    def get_properties(self):
+        result = self.read_properties()
         self.lock.acquire()
-        results = []
-        for entry in self.status_data['results']:
-            result_dir = os.path.join(self.data_dir, entry['name'])
-            results.append(
-                (
-                    entry['run_id'],
-                    entry['name'],
-                    entry['start'],
-                    entry['state'],
-                )
-            )
+        if result != self.current_job_properties:
+            self.current_job_properties = result
+            self.publish_status()
         self.lock.release()
-        return results
+        return result
+
+    def get_results(self):
+        """
+        Return a list of (run_id, name, start, state) tuples.
+        """
+        return list(self.status['results'])
 
-    def save_properties(self, properties):
+    def save_properties(self, properties, filename = None):
+        """
+        Save the properties as last.properties and remember the file
+        name they were uploaded as.
+        """
         self.lock.acquire()
         last_path = os.path.join(self.data_dir, 'last.properties')
         with open(last_path, 'w') as fd:
             fd.write(properties)
         self.current_job_properties = properties
+        if filename is not None and filename != self.status_data['filename']:
+            self.status_data['filename'] = filename
+            self.publish_status(save = True)
+        else:
+            self.publish_status()
         self.lock.release()
 
+    def get_properties_filename(self):
+        return self.status['filename']
+
     def get_report(self, run_id):
         try:
             run_id = int(run_id)
@@ -230,15 +357,28 @@ class BenchmarkSQL:
         except Exception as e:
             return "What?"
 
-        self.lock.acquire()
         html_path = os.path.join(self.data_dir, "result_{0:06d}.html".format(run_id))
         data_path = os.path.join(self.data_dir, "result_{0:06d}".format(run_id))
+
+        self.lock.acquire()
         new_results = [x for x in self.status_data['results'] if x['run_id'] != run_id]
         if len(new_results) > 0:
             new_count = max([x['run_id'] for x in new_results])
         else:
             new_count = 0
+        self.status_data['run_count'] = new_count
+        self.status_data['results'] = new_results
+        self.publish_status(save = True)
+        with open(os.path.join(self.data_dir, 'run_seq.dat'), 'w') as fd:
+            fd.write(str(new_count) + '\n')
+        self.lock.release()
 
+        # ----
+        # The result is no longer listed, so we can remove its files
+        # without holding the lock.
+        # ----
+        with self.txsummary_lock:
+            self.txsummary_cache.pop(run_id, None)
         try:
             shutil.rmtree(data_path)
         except Exception as e:
@@ -247,14 +387,6 @@ class BenchmarkSQL:
             os.remove(html_path)
         except Exception as e:
             print(str(e))
-        self.status_data['run_count'] = new_count
-        self.status_data['results'] = new_results
-
-        self.save_status()
-        with open(os.path.join(self.data_dir, 'run_seq.dat'), 'w') as fd:
-            fd.write(str(new_count) + '\n')
-
-        self.lock.release()
 
     def run_benchmark(self):
         self.lock.acquire()
@@ -271,14 +403,14 @@ class BenchmarkSQL:
                 'start':    time.asctime(),
                 'state':    'RUN',
             }] + self.status_data['results']
-        self.save_status()
 
         self.current_job_type = 'RUN'
         self.current_job_id = run_id
         self.current_job_name = "result_{0:06d}".format(run_id)
         self.current_job = RunBenchmark(self, run_id)
-        self.current_job_output = ""
+        self.reset_job_output()
         self.current_job_start = time.time()
+        self.publish_status(save = True)
         self.current_job.start()
         self.lock.release()
 
@@ -290,8 +422,9 @@ class BenchmarkSQL:
 
         self.current_job_type = 'BUILD'
         self.current_job = RunDatabaseBuild(self)
-        self.current_job_output = ""
+        self.reset_job_output()
         self.current_job_start = time.time()
+        self.publish_status()
         self.current_job.start()
         self.lock.release()
 
@@ -303,8 +436,9 @@ class BenchmarkSQL:
 
         self.current_job_type = 'DESTROY'
         self.current_job = RunDatabaseDestroy(self)
-        self.current_job_output = ""
+        self.reset_job_output()
         self.current_job_start = time.time()
+        self.publish_status()
         self.current_job.start()
         self.lock.release()
 
@@ -323,9 +457,257 @@ class BenchmarkSQL:
                 entry['state'] = 'CANCELED'
                 break
         os.killpg(os.getpgid(self.current_job.proc.pid), signal.SIGKILL)
-        self.save_status()
+        self.publish_status(save = True)
+        self.lock.release()
+
+class JobOutput:
+    """
+    The output of one job. All output is written to a spool file as it
+    arrives, but only the last MAX_LINES lines are kept in memory. Lines
+    are addressed by their number (offset), older lines are read back
+    from the spool file using an index of the byte position of every
+    INDEX_STRIDE-th line. Output that does not end in a newline is held
+    back until the rest of its line arrives, so that the lines counted
+    are the lines in the spool file.
+    """
+    MAX_LINES = 10000
+    INDEX_STRIDE = 256
+
+    def __init__(self, fname, generation):
+        self.fname = fname
+        self.generation = generation
+        self.cond = threading.Condition()
+        self.lines = collections.deque(maxlen = self.MAX_LINES)
+        self.num_lines = 0
+        self.errors = 0
+        self.size = 0
+        self.index = array.array('q')
+        self.pending = ''
+        self.closed = False
+
+        # ----
+        # Remove a left over spool file first so that we never truncate
+        # a file that a previous JobOutput still refers to.
+        # ----
+        try:
+            os.unlink(fname)
+        except FileNotFoundError:
+            pass
+        self.fd = open(fname, 'w+b')
+
+    def __len__(self):
+        with self.cond:
+            return self.num_lines
+
+    def append(self, output):
+        """
+        Add output to the job, counting the ERROR lines in it.
+        """
+        with self.cond:
+            if self.closed:
+                return
+            lines = (self.pending + str(output)).splitlines(keepends = True)
+            # A trailing '\r' may still be followed by its '\n'
+            if len(lines) > 0 and not lines[-1].endswith('\n'):
+                self.pending = lines.pop()
+            else:
+                self.pending = ''
+            self._add_lines(lines)
+            self.cond.notify_all()
+
+    def _add_lines(self, lines):
+        for line in lines:
+            if self.num_lines % self.INDEX_STRIDE == 0:
+                self.index.append(self.size)
+            data = line.encode('utf-8')
+            self.fd.write(data)
+            self.size += len(data)
+            self.lines.append(line)
+            self.num_lines += 1
+            if ' ERROR - ' in line:
+                self.errors += 1
+        self.fd.flush()
+
+    def read(self, offset = 0):
+        """
+        Return a tuple of the number of lines and the output from line
+        offset on. A negative offset counts from the end, like a slice.
+        """
+        with self.cond:
+            num_lines = self.num_lines
+            if offset < 0:
+                offset = max(num_lines + offset, 0)
+            first = num_lines - len(self.lines)
+            if offset >= first:
+                return (num_lines, ''.join(
+                        itertools.islice(self.lines, offset - first, None)))
+            if self.closed:
+                return (num_lines, '')
+            start = self.index[offset // self.INDEX_STRIDE]
+            size = self.size - start
+            try:
+                fileno = os.dup(self.fd.fileno())
+            except OSError:
+                return (num_lines, '')
+
+        # ----
+        # The lines before the in-memory ones are read back from the
+        # spool file outside the lock. Everything up to size has been
+        # flushed and never changes. We read from a duplicate of the
+        # file descriptor, so a concurrent close() can't pull it away.
+        # ----
+        try:
+            data = os.pread(fileno, size, start)
+        except OSError:
+            return (num_lines, '')
+        finally:
+            os.close(fileno)
+        lines = data.decode('utf-8').splitlines(keepends = True)
+        return (num_lines, ''.join(lines[offset % self.INDEX_STRIDE:]))
+
+    def wait(self, offset, timeout = None):
+        """
+        Wait until there are more than offset lines or the output is
+        closed.
+        """
+        with self.cond:
+            if offset >= self.num_lines and not self.closed:
+                self.cond.wait(timeout)
+
+    def move(self, fname):
+        """
+        Rename the spool file to fname. The open file stays valid, so
+        the output can still be read back afterwards.
+        """
+        with self.cond:
+            self.fd.flush()
+            try:
+                os.replace(self.fname, fname)
+            except OSError:
+                shutil.copyfile(self.fname, fname)
+            self.fname = fname
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            if self.pending != '':
+                self._add_lines([self.pending])
+                self.pending = ''
+            self.closed = True
+            self.fd.close()
+            self.cond.notify_all()
+
+class LiveMetrics:
+    """
+    Rolling metrics of a running benchmark, computed by tailing its
+    result.csv. Only the complete lines appended since the last update
+    are parsed and only the rows of the last MAX_WINDOW seconds are
+    kept, so memory use is bounded no matter how long the run is.
+    """
+    MAX_WINDOW = 600
+    TTYPES = ['NEW_ORDER', 'PAYMENT', 'ORDER_STATUS', 'STOCK_LEVEL',
+              'DELIVERY', 'DELIVERY_BG']
+
+    def __init__(self, run_id, fname):
+        self.run_id = run_id
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.offset = 0
+        self.last_second = 0
+        self.rows = collections.deque()
+        self.totals = {tt: 0 for tt in self.TTYPES}
+
+    def update(self):
+        """
+        Parse the lines appended to result.csv since the last update.
+        Caller must hold self.lock.
+        """
+        try:
+            with open(self.fname, 'rb') as fd:
+                fd.seek(self.offset)
+                buf = fd.read()
+        except FileNotFoundError:
+            # The benchmark has not created its result directory yet.
+            return
+        end = buf.rfind(b'\n') + 1
+        lines = buf[:end].decode('utf-8').splitlines()
+        if self.offset == 0 and len(lines) > 0:
+            lines = lines[1:]
+        self.offset += end
+
+        # ----
+        # Rows are (second, ttype, numtrans, sumlatencyms, minlatencyms,
+        # maxlatencyms, sumdelayms, mindelayms, maxdelayms).
+        # ----
+        for line in lines:
+            row = line.split(',')
+            if row[0] not in self.totals:
+                continue
+            row = [int(row[1]), row[0]] + [int(v) for v in row[2:]]
+            self.totals[row[1]] += row[2]
+            self.last_second = max(self.last_second, row[0])
+            self.rows.append(row)
+        while len(self.rows) > 0 and self.rows[0][0] <= self.last_second - self.MAX_WINDOW:
+            self.rows.popleft()
+
+    def get_metrics(self, window = 60):
+        """
+        Return tpmC, total tpm and per transaction type latency and
+        delay over the last window seconds of the run.
+        """
+        window = max(1, min(int(window), self.MAX_WINDOW))
+        self.lock.acquire()
+        self.update()
+        ttypes = {tt: {
+                'count': 0,
+                'total_count': self.totals[tt],
+                'sum_latency_ms': 0,
+                'max_latency_ms': 0,
+                'sum_delay_ms': 0,
+                'max_delay_ms': 0,
+            } for tt in self.TTYPES}
+        for row in reversed(self.rows):
+            if row[0] <= self.last_second - window:
+                break
+            entry = ttypes[row[1]]
+            entry['count'] += row[2]
+            entry['sum_latency_ms'] += row[3]
+            entry['max_latency_ms'] = max(entry['max_latency_ms'], row[5])
+            entry['sum_delay_ms'] += row[6]
+            entry['max_delay_ms'] = max(entry['max_delay_ms'], row[8])
+        last_second = self.last_second
         self.lock.release()
 
+        # ----
+        # Rows for second S cover the interval ending at S, so the rows
+        # in the window cover window seconds (less at the beginning).
+        # ----
+        span = min(window, last_second)
+        for tt, entry in ttypes.items():
+            if entry['count'] > 0:
+                entry['avg_latency_ms'] = entry['sum_latency_ms'] / entry['count']
+                entry['avg_delay_ms'] = entry['sum_delay_ms'] / entry['count']
+            else:
+                entry['avg_latency_ms'] = 0.0
+                entry['avg_delay_ms'] = 0.0
+            del entry['sum_latency_ms']
+            del entry['sum_delay_ms']
+        if span > 0:
+            tpm_c = ttypes['NEW_ORDER']['count'] * 60.0 / span
+            tpm_total = sum([ttypes[tt]['count'] for tt in self.TTYPES
+                             if tt != 'DELIVERY_BG']) * 60.0 / span
+        else:
+            tpm_c = tpm_total = 0.0
+        return {
+                'run_id': self.run_id,
+                'second': last_second,
+                'window': window,
+                'tpm_c': tpm_c,
+                'tpm_total': tpm_total,
+                'ttypes': ttypes,
+            }
+
 class RunBenchmark(threading.Thread):
     def __init__(self, bench, run_id):
         threading.Thread.__init__(self)
@@ -399,9 +781,7 @@ class RunBenchmark(threading.Thread):
         else:
             self.bench.add_job_output("\nBenchmarkSQL run complete\n")
 
-        result_log = os.path.join(result_dir, 'console.log')
-        with codecs.open(result_log, 'w', encoding='utf8') as fd:
-            fd.write(self.bench.current_job_output)
+        self.bench.save_job_output(os.path.join(result_dir, 'console.log'))
 
 class RunDatabaseBuild(threading.Thread):
     def __init__(self, bench):
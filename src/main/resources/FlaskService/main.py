@@ -20,9 +20,7 @@ def index():
             propf.seek(0)
             props = propf.read().decode('utf-8')
             if props != "":
-                bench.save_properties(props)
-                bench.status_data['filename'] = propf.filename
-                bench.save_status()
+                bench.save_properties(props, filename = propf.filename)
                 return flask.redirect(flask.url_for("index"))
 
     if 'action' in form:
@@ -31,7 +29,7 @@ def index():
         if form['action'] == 'SAVE':
             bench.save_properties(form['properties'])
             headers = werkzeug.datastructures.Headers()
-            headers.add('Content-Disposition', 'attachment', filename=bench.status_data['filename'])
+            headers.add('Content-Disposition', 'attachment', filename=bench.get_properties_filename())
             return flask.Response(form['properties'],
                                   headers = headers,
                                   mimetype = 'application/octet-stream')
@@ -71,7 +69,13 @@ def index():
         data['state_cancel'] = ''
         data['state_refresh'] = ''
 
-    data['current_job_output'] = bench.get_job_output()
+    # ----
+    # The page only shows the tail of a long job output.
+    # ----
+    status = bench.get_status(-benchmarksql.JobOutput.MAX_LINES)
+    data['current_job_output'] = status['current_job_output']
+    data['current_job_generation'] = status['current_job_generation']
+    data['current_job_output_offset'] = status['current_job_output_offset']
     data['url_job_status'] = flask.url_for('job_status')
 
     data['results'] = bench.get_results()
@@ -94,39 +98,42 @@ def api_call():
     try:
         req = json.loads(data['request'])
         if req['command'].lower() == 'status':
-            result = api_call_status()
+            result = api_call_status(req)
         elif req['command'].lower() == 'run':
-            status = bench.get_status()
+            status = bench.get_status(None)
             if status['current_job_type'] != 'IDLE':
                 raise Exception("Current job type is {0}".format(status['current_job_type']))
             if 'properties' in req:
                 bench.save_properties(req['properties'])
             bench.run_benchmark()
-            result = api_call_status()
+            result = api_call_status(req)
         elif req['command'].lower() == 'build':
-            status = bench.get_status()
+            status = bench.get_status(None)
             if status['current_job_type'] != 'IDLE':
                 raise Exception("Current job type is {0}".format(status['current_job_type']))
             if 'properties' in req:
                 bench.save_properties(req['properties'])
             bench.run_build()
-            result = api_call_status()
+            result = api_call_status(req)
         elif req['command'].lower() == 'destroy':
-            status = bench.get_status()
+            status = bench.get_status(None)
             if status['current_job_type'] != 'IDLE':
                 raise Exception("Current job type is {0}".format(status['current_job_type']))
             if 'properties' in req:
                 bench.save_properties(req['properties'])
             bench.run_destroy()
-            result = api_call_status()
+            result = api_call_status(req)
         elif req['command'].lower() == 'cancel':
             bench.cancel_job()
-            result = api_call_status()
+            result = api_call_status(req)
+        elif req['command'].lower() == 'metrics':
+            result = api_call_status(req)
+            result['metrics'] = bench.get_live_metrics(req.get('window', 60))
         elif req['command'].lower() == 'txsummary':
             if 'run_id' not in req:
                 raise Exception("command txsummary requires run_id")
             txsummary = bench.get_job_txsummary(req['run_id'])
-            result = api_call_status()
+            result = api_call_status(req)
             result['txsummary'] = txsummary
         else:
             result = {
@@ -140,29 +147,124 @@ def api_call():
             }
     return flask.Response(json.dumps(result), mimetype = 'application/json')
 
-def api_call_status():
-    status = bench.get_status()
-    return {
+def api_call_status(req = {}):
+    # ----
+    # The request can ask for only the output after line output_offset
+    # or for no output at all with 'output': false.
+    # ----
+    if req.get('output', True):
+        output_offset = int(req.get('output_offset', 0))
+    else:
+        output_offset = None
+    status = bench.get_status(output_offset)
+    result = {
             'rc': 'OK',
             'message': 'Success',
             'current_job_type': status['current_job_type'],
             'current_job_id': status['current_job_id'],
             'current_job_name': status['current_job_name'],
-            'current_job_output': status['current_job_output'],
+            'current_job_generation': status['current_job_generation'],
+            'current_job_output_offset': status['current_job_output_offset'],
             'current_job_start': status['current_job_start'],
             'current_job_properties': status['current_job_properties'],
         }
+    if output_offset is not None:
+        result['current_job_output'] = status['current_job_output']
+    return result
 
 
 @app.route('/job_status')
 def job_status():
+    # ----
+    # Without arguments this returns the entire job output. Clients
+    # that pass the generation and offset from the previous response
+    # only get the new output, or none at all with output=0.
+    # ----
+    args = flask.request.args
+    if args.get('output', '1') == '0':
+        status = bench.get_status(None)
+        output = None
+        generation = status['current_job_generation']
+        offset = status['current_job_output_offset']
+    else:
+        generation, offset, output = bench.wait_job_output(
+                int(args.get('generation', -1)), int(args.get('offset', 0)), 0)
     result = [
             bench.get_job_type(),
             bench.get_job_runtime(),
-            bench.get_job_output(),
+            output,
+            generation,
+            offset,
         ]
     return json.dumps(result)
 
+@app.route('/job_output')
+def job_output():
+    """
+    Long-poll for new job output after offset. Waits up to wait seconds
+    for new output to arrive.
+    """
+    args = flask.request.args
+    generation, offset, output = bench.wait_job_output(
+            int(args.get('generation', -1)), int(args.get('offset', 0)),
+            min(float(args.get('wait', 30)), 60.0))
+    result = {
+            'generation': generation,
+            'offset': offset,
+            'output': output,
+        }
+    return flask.Response(json.dumps(result), mimetype = 'application/json')
+
+@app.route('/job_output_stream')
+def job_output_stream():
+    """
+    Server-Sent Events stream of the job output. Every event carries
+    the output since the last one and has the id GENERATION:OFFSET, so
+    that a reconnecting EventSource resumes where it left off. A reset
+    event is sent when a new job started.
+    """
+    args = flask.request.args
+    last_id = flask.request.headers.get('Last-Event-ID')
+    try:
+        if last_id is not None:
+            generation, offset = [int(v) for v in last_id.split(':')]
+        else:
+            generation = int(args.get('generation', -1))
+            offset = int(args.get('offset', 0))
+    except ValueError:
+        # A garbled position starts a fresh stream of the current job
+        generation, offset = -1, 0
+
+    def stream(generation, offset):
+        while True:
+            new_generation, new_offset, output = bench.wait_job_output(
+                    generation, offset, 15.0)
+            if new_generation != generation:
+                yield "event: reset\ndata: {0}\n\n".format(new_generation)
+            elif new_offset == offset:
+                yield ": keepalive\n\n"
+                continue
+            generation, offset = new_generation, new_offset
+            yield "id: {0}:{1}\nevent: output\ndata: {2}\n\n".format(
+                    generation, offset, json.dumps(output))
+
+    return flask.Response(flask.stream_with_context(stream(generation, offset)),
+                          mimetype = 'text/event-stream',
+                          headers = {'Cache-Control': 'no-cache'})
+
+@app.route('/live_metrics')
+def live_metrics():
+    args = flask.request.args
+    try:
+        window = int(args.get('window', 60))
+    except ValueError:
+        window = 60
+    result = {
+            'current_job_type': bench.get_job_type(),
+            'metrics': bench.get_live_metrics(window),
+        }
+    return flask.Response(json.dumps(result), mimetype = 'application/json')
+
 @app.route('/cancel_job')
 def cancel_job():
     result = [
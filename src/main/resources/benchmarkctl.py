@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
 import requests
+import requests.adapters
+import urllib3.exceptions
+import threading
 import json
 import re
 import sys
+import time
 
 def main():
     if len(sys.argv) < 5:
@@ -19,11 +24,25 @@ def main():
 
     extra_opts = {}
     for opt in sys.argv[5:]:
-        key, val = opt.split('=')
+        if '=' not in opt:
+            continue
+        key, val = opt.split('=', 1)
         extra_opts[key] = val
 
     # TODO: sanity checks for all args
 
+    # ----
+    # APPNODE can be a comma separated list of app nodes or "all"
+    # for all app nodes in the config. More than one app node are
+    # driven in parallel.
+    # ----
+    if appnode == 'all':
+        appnodes = list(config['appnodes'].keys())
+    else:
+        appnodes = appnode.split(',')
+    if len(appnodes) > 1:
+        sys.exit(cluster_main(config, command, appnodes, dbnode, extra_opts))
+
     bmsql = BenchmarkSQL(config, appnode, dbnode, extra_opts)
 
     if command == 'build':
@@ -43,6 +62,15 @@ def main():
         result = bmsql.status()
         print(result['current_job_type'])
         print(result['current_job_id'])
+    elif command == 'wait':
+        result = bmsql.wait()
+        print(result['current_job_type'])
+        print(result['current_job_id'])
+    elif command == 'watch':
+        result = bmsql.watch(callback = print_watch)
+        if result.get('rc') != 'OK':
+            print("ERROR %s"%(result.get('message'),))
+            sys.exit(1)
     elif command == 'txsummary':
         result = bmsql.txsummary(sys.argv[5])
         print(json.dumps(result['txsummary'], indent=2))
@@ -50,25 +78,137 @@ def main():
         print("unknown command '%s'"%(command,))
         sys.exit(2)
 
+def cluster_main(config, command, appnodes, dbnode, extra_opts):
+    cluster = BenchmarkSQLCluster(config, appnodes, dbnode, extra_opts)
+
+    try:
+        if command == 'build':
+            results = cluster.build()
+        elif command == 'destroy':
+            results = cluster.destroy()
+        elif command == 'run':
+            results = cluster.run()
+        elif command == 'cancel':
+            results = cluster.cancel()
+        elif command == 'status':
+            results = cluster.status()
+        elif command == 'wait':
+            results = cluster.wait()
+        elif command == 'watch':
+            results = cluster.watch(callback = print_cluster_watch)
+        else:
+            print("unknown or unsupported command '%s' for multiple app nodes"%(command,))
+            return 2
+    except Exception as e:
+        print("ERROR %s"%(str(e),))
+        return 1
+
+    # ----
+    # One line per app node followed by the aggregated state.
+    # ----
+    rc = 0
+    for appnode in appnodes:
+        result = results[appnode]
+        if result.get('rc') != 'OK':
+            print("%s ERROR %s"%(appnode, result.get('message')))
+            rc = 1
+        else:
+            print("%s %s %s"%(appnode, result['current_job_type'],
+                              result['current_job_id']))
+    print(cluster.aggregate_state(results))
+    return rc
+
+def print_watch(result):
+    line = "%s %s %s"%(time.strftime('%H:%M:%S'),
+                       result.get('current_job_type', 'ERROR'),
+                       result.get('current_job_id', '-'))
+    metrics = result.get('metrics')
+    if metrics:
+        line += " second=%d tpmC=%.0f tpmTotal=%.0f errors=%d"%(
+                metrics['second'], metrics['tpm_c'], metrics['tpm_total'],
+                metrics.get('errors', 0))
+    print(line, flush = True)
+
+def print_cluster_watch(state, results):
+    print("%s %s %s"%(time.strftime('%H:%M:%S'), state,
+                      ' '.join(["%s=%s"%(appnode, result.get('current_job_type', 'ERROR'))
+                                for appnode, result in results.items()])),
+          flush = True)
+
 def usage():
     print("""usage: benchmarkctl CONFIG.json COMMAND APPNODE DBNODE
+
+COMMAND is one of build, destroy, run, cancel, status, wait, watch
+or txsummary (followed by the run ID). wait and watch poll the status
+until the current job has finished, watch also prints it every time.
+
+APPNODE can be a comma separated list of app nodes or "all" to
+run COMMAND on several app nodes in parallel.
+
+The optional "http" section of the config can set "connect_timeout"
+and "timeout" (seconds), "retries" and "backoff" (seconds).
 """, file = sys.stderr)
 
+# ----
+# HTTP defaults. They can be overridden in the "http" section of the
+# config. The timeouts are in seconds, the backoff is the delay of the
+# first retry, which then doubles with every further retry.
+# ----
+HTTP_DEFAULTS = {
+    'connect_timeout':  5.0,
+    'timeout':          60.0,
+    'retries':          5,
+    'backoff':          0.5,
+}
+
+# ----
+# Gateway errors that idempotent requests are retried on.
+# ----
+RETRY_STATUS = (502, 503, 504)
+
+def new_session(pool_size = 1):
+    """
+    Create a requests Session that keeps up to pool_size connections
+    per host alive. The session itself never retries, all retries are
+    done by BenchmarkSQL.api_call().
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections = pool_size,
+                                            pool_maxsize = pool_size,
+                                            max_retries = 0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def connect_failed(e):
+    """
+    Return True if the requests exception e means that no connection
+    to the service could be made, so the request never reached it.
+    """
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if len(e.args) > 0 else None
+    return isinstance(reason, (urllib3.exceptions.NewConnectionError,
+                               urllib3.exceptions.ConnectTimeoutError))
+
 
 class BenchmarkSQL:
-    def __init__(self, config, appnode, dbnode, extra_opts = None):
+    def __init__(self, config, appnode, dbnode, extra_opts = None,
+                 session = None):
         with open(config['properties_template'], 'r') as fd:
             properties = fd.read()
-        overrides = config['properties']
+        overrides = dict(config['properties'])
         overrides.update(config['dbnodes'][dbnode]['properties'])
         overrides.update(config['appnodes'][appnode]['properties'])
         if extra_opts is not None:
             overrides.update(extra_opts)
         for key in overrides:
-            properties = re.sub('^%s=.*$'%(key),
-                                '%s=%s'%(key, overrides[key]),
-                                properties,
-                                flags = re.MULTILINE)
+            properties, n = re.subn('^%s=.*$'%(key),
+                                    '%s=%s'%(key, overrides[key]),
+                                    properties,
+                                    flags = re.MULTILINE)
+            if n == 0:
+                properties += "\n\n" + key + "=" + overrides[key] + "\n"
 
         self.config = config
         self.appnode = appnode
@@ -77,58 +217,209 @@ class BenchmarkSQL:
         self.dbconf = config['dbnodes'][dbnode]
         self.properties = properties
 
-    def status(self):
+        self.http = dict(HTTP_DEFAULTS)
+        self.http.update(config.get('http', {}))
+        if session is None:
+            session = new_session()
+        self.session = session
+
+    def api_call(self, req, idempotent = False):
+        """
+        Send an API request and return the decoded response. The job
+        output is never requested. Failed connection attempts are
+        retried with exponential backoff for all requests. These never
+        reached the service, so retrying is safe for a run command too.
+        Requests that only read are also retried after a read timeout,
+        a dropped connection or a gateway error. A proxy may already
+        have forwarded a request it answers with a gateway error, so
+        those are not retried for anything else.
+        """
         url = self.appconf['api_url']
+        req = dict(req, output = False)
+        timeout = (self.http['connect_timeout'], self.http['timeout'])
+        attempt = 0
+        while True:
+            try:
+                res = self.session.post(url, data = {'request': json.dumps(req)},
+                                        timeout = timeout)
+                if (not idempotent or res.status_code not in RETRY_STATUS
+                        or attempt >= self.http['retries']):
+                    res.raise_for_status()
+                    return res.json()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if ((not idempotent and not connect_failed(e))
+                        or attempt >= self.http['retries']):
+                    raise e
+            time.sleep(self.http['backoff'] * (2 ** attempt))
+            attempt += 1
+
+    def status(self):
         req = {
             'command': 'status'
         }
-        res = requests.post(url, data = {'request': json.dumps(req)})
-        return json.loads(res.text)
+        return self.api_call(req, idempotent = True)
+
+    def metrics(self, window = 60):
+        req = {
+            'command': 'metrics',
+            'window': window
+        }
+        return self.api_call(req, idempotent = True)
+
+    def wait(self, interval = 5.0):
+        """
+        Poll the status until the current job has finished.
+        """
+        while True:
+            result = self.status()
+            if result.get('rc') != 'OK' or result['current_job_type'] == 'IDLE':
+                return result
+            time.sleep(interval)
+
+    def watch(self, interval = 5.0, callback = None):
+        """
+        Like wait, but call callback(result) after every poll. While
+        a benchmark is running the result includes its live metrics.
+        """
+        while True:
+            start = time.time()
+            result = self.metrics()
+            if callback is not None:
+                callback(result)
+            if result.get('rc') != 'OK' or result['current_job_type'] == 'IDLE':
+                return result
+            time.sleep(max(0.0, interval - (time.time() - start)))
 
     def txsummary(self, run_id):
-        url = self.appconf['api_url']
         req = {
             'command': 'txsummary',
             'run_id': int(run_id)
         }
-        res = requests.post(url, data = {'request': json.dumps(req)})
-        return json.loads(res.text)
+        return self.api_call(req, idempotent = True)
 
     def build(self):
-        url = self.appconf['api_url']
         req = {
             'command': 'build',
             'properties': self.properties
         }
-        res = requests.post(url, data = {'request': json.dumps(req)})
-        return json.loads(res.text)
+        return self.api_call(req)
 
     def destroy(self):
-        url = self.appconf['api_url']
         req = {
             'command': 'destroy',
             'properties': self.properties
         }
-        res = requests.post(url, data = {'request': json.dumps(req)})
-        return json.loads(res.text)
+        return self.api_call(req)
 
     def run(self):
-        url = self.appconf['api_url']
         req = {
             'command': 'run',
             'properties': self.properties
         }
-        res = requests.post(url, data = {'request': json.dumps(req)})
-        return json.loads(res.text)
+        return self.api_call(req)
 
     def cancel(self):
-        url = self.appconf['api_url']
         req = {
-            'command': 'cancel',
-            'properties': self.properties
+            'command': 'cancel'
         }
-        res = requests.post(url, data = {'request': json.dumps(req)})
-        return json.loads(res.text)
+        return self.api_call(req)
+
+
+class BenchmarkSQLCluster:
+    """
+    Drive the BenchmarkSQL services on several app nodes against
+    the same DB node in parallel. All calls go out concurrently over
+    one pooled HTTP session and return a dict of the results by app
+    node. A failed call has the result rc 'ERROR'.
+    """
+    def __init__(self, config, appnodes, dbnode, extra_opts = None):
+        self.appnodes = list(appnodes)
+        self.session = new_session(len(self.appnodes))
+        self.nodes = {
+            appnode: BenchmarkSQL(config, appnode, dbnode, extra_opts,
+                                  session = self.session)
+            for appnode in self.appnodes
+        }
+
+    def call_all(self, func):
+        """
+        Call func(bmsql) for all app nodes at once, one thread each.
+        """
+        def call(appnode):
+            try:
+                return func(self.nodes[appnode])
+            except Exception as e:
+                return {'rc': 'ERROR', 'message': str(e)}
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers = len(self.appnodes)) as pool:
+            return dict(zip(self.appnodes, pool.map(call, self.appnodes)))
+
+    def aggregate_state(self, results):
+        """
+        Return the combined job type of all app nodes: the job type if
+        all agree, ERROR if any call failed or MIXED otherwise.
+        """
+        states = set()
+        for result in results.values():
+            if result.get('rc') != 'OK':
+                return 'ERROR'
+            states.add(result['current_job_type'])
+        if len(states) == 1:
+            return states.pop()
+        return 'MIXED'
+
+    def status(self):
+        return self.call_all(lambda bmsql: bmsql.status())
+
+    def wait(self, interval = 5.0):
+        return self.call_all(lambda bmsql: bmsql.wait(interval))
+
+    def watch(self, interval = 5.0, callback = None):
+        """
+        Poll the status of all app nodes together until none of them
+        has a job any more, calling callback(state, results) with the
+        aggregated state after every poll.
+        """
+        while True:
+            start = time.time()
+            results = self.status()
+            state = self.aggregate_state(results)
+            if callback is not None:
+                callback(state, results)
+            if state in ['IDLE', 'ERROR']:
+                return results
+            time.sleep(max(0.0, interval - (time.time() - start)))
+
+    def build(self):
+        return self.call_all(lambda bmsql: bmsql.build())
+
+    def destroy(self):
+        return self.call_all(lambda bmsql: bmsql.destroy())
+
+    def cancel(self):
+        return self.call_all(lambda bmsql: bmsql.cancel())
+
+    def run(self):
+        """
+        Start the benchmark on all app nodes at the same time. A status
+        call first checks that all nodes are idle and opens the pooled
+        connections. The run requests are then held back until every
+        thread is ready to send, so that the start times only differ
+        by the network latency.
+        """
+        results = self.status()
+        if self.aggregate_state(results) != 'IDLE':
+            busy = ["%s=%s"%(appnode, result.get('current_job_type', 'ERROR'))
+                    for appnode, result in results.items()
+                    if result.get('current_job_type') != 'IDLE']
+            raise Exception("app nodes not idle: %s"%(', '.join(busy),))
+
+        barrier = threading.Barrier(len(self.appnodes))
+        def start(bmsql):
+            barrier.wait()
+            return bmsql.run()
+        return self.call_all(start)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# ----------------------------------------------------------------------
+# bmsqlMetricStore.py
+#
+#   Binary storage for the OS metric data of a benchmark run. The OS
+#   metric collectors write it, the report generator reads it.
+#
+#   The store consists of two files in the result data directory:
+#
+#   os-metric.dat   Chunks of float64 (time, value) rows. Every chunk
+#                   belongs to one series (host and metric). The rows
+#                   of a chunk are contiguous, so every chunk can be
+#                   used directly as a (rows, 2) array of a memory map.
+#
+#   os-metric.idx   The index, one JSON line per chunk with the host,
+#                   metric, first row and number of rows of the chunk.
+#                   The first line is a header with the format version
+#                   and byte order of the data file.
+#
+#   Both files are only ever appended to. A chunk is added to the
+#   index after its data has been written, so a collector may flush
+#   data at any time and a reader never sees incomplete chunks.
+#
+#   Run as a script it exports a store as os-metric.json, the format
+#   the collectors used to write.
+#
+#   Usage: bmsqlMetricStore.py [-o OUTPUT_FILE] DATA_DIR
+# ----------------------------------------------------------------------
+import os.path
+import sys
+import math
+import getopt
+import json
+from array import array
+
+DATA_FNAME = 'os-metric.dat'
+INDEX_FNAME = 'os-metric.idx'
+JSON_FNAME = 'os-metric.json'
+FORMAT_VERSION = 1
+
+def main():
+    output = None
+
+    opts, args = getopt.getopt(sys.argv[1:], "o:", ["output=", ])
+    for opt, val in opts:
+        if opt in ['-o', '--output']:
+            output = val
+
+    if len(args) != 1:
+        print("usage: {} [-o OUTPUT_FILE] DATA_DIR".format(sys.argv[0]),
+              file = sys.stderr)
+        return 2
+
+    export_json(args[0], output)
+    return 0
+
+def exists(datadir):
+    """
+    Return True if datadir contains a metric store.
+    """
+    return os.path.exists(os.path.join(datadir, INDEX_FNAME))
+
+def read_index(datadir):
+    """
+    Read the index of the metric store in datadir. Returns the header
+    and a dict of (host, metric) mapping to the list of (start, end)
+    rows of the chunks of that series, in the order they were written.
+    """
+    chunks = {}
+    with open(os.path.join(datadir, INDEX_FNAME), 'r') as fd:
+        header = json.loads(fd.readline())
+        if header['version'] != FORMAT_VERSION:
+            raise Exception("unsupported metric store version {}".format(
+                            header['version']))
+        for line in fd:
+            # A collector may be writing the last line right now
+            if not line.endswith('\n'):
+                break
+            host, metric, start, nrows = json.loads(line)
+            chunks.setdefault((host, metric), []).append(
+                    (start, start + nrows))
+    return header, chunks
+
+def export_json(datadir, fname = None):
+    """
+    Write the metric store in datadir as os-metric.json. Missing
+    values (NaN) become null. Like the writer this only needs the
+    standard library.
+    """
+    if fname is None:
+        fname = os.path.join(datadir, JSON_FNAME)
+    header, chunks = read_index(datadir)
+    result = {}
+    with open(os.path.join(datadir, DATA_FNAME), 'rb') as fd:
+        for (host, metric), series_chunks in chunks.items():
+            rows = []
+            for start, end in series_chunks:
+                buf = array('d')
+                fd.seek(start * 16)
+                buf.frombytes(fd.read((end - start) * 16))
+                if header['byteorder'] != sys.byteorder:
+                    buf.byteswap()
+                rows.extend(zip(buf[0::2], buf[1::2]))
+            rows.sort(key = lambda row: row[0])
+            result.setdefault(host, {})[metric] = [
+                    (t, None if math.isnan(v) else v) for t, v in rows]
+    with open(fname, 'w') as fd:
+        fd.write(json.dumps(result))
+
+class MetricStoreWriter:
+    """
+    Append time series to the metric store in datadir. This only needs
+    the standard library, so the collectors can run on systems that
+    don't have numpy.
+    """
+    def __init__(self, datadir, append = False):
+        self.datadir = datadir
+        mode = 'ab' if append and exists(datadir) else 'wb'
+        self.data_fd = open(os.path.join(datadir, DATA_FNAME), mode)
+        self.index_fd = open(os.path.join(datadir, INDEX_FNAME),
+                             mode[0] + 't')
+        self.nrows = self.data_fd.tell() // 16
+        if self.index_fd.tell() == 0:
+            self.index_fd.write(json.dumps({
+                    'version': FORMAT_VERSION,
+                    'byteorder': sys.byteorder,
+                }) + '\n')
+
+    def append(self, host, metric, rows):
+        """
+        Append an iterable of (time, value) rows to a series. A value
+        of None is stored as NaN.
+        """
+        buf = array('d')
+        for t, v in rows:
+            buf.append(t)
+            buf.append(math.nan if v is None else v)
+        self.append_array(host, metric, buf)
+
+    def append_columns(self, host, metric, times, values):
+        """
+        Append the sequences times and values (of equal length) to a
+        series.
+        """
+        buf = array('d', bytes(16 * len(times)))
+        buf[0::2] = array('d', times)
+        buf[1::2] = array('d', values)
+        self.append_array(host, metric, buf)
+
+    def append_array(self, host, metric, buf):
+        """
+        Append an array('d') of alternating time and value to a series.
+        """
+        if len(buf) == 0:
+            return
+        self.data_fd.write(buf.tobytes())
+        self.data_fd.flush()
+        self.index_fd.write(json.dumps([host, metric, self.nrows,
+                                        len(buf) // 2]) + '\n')
+        self.nrows += len(buf) // 2
+
+    def write_dict(self, os_metric):
+        """
+        Append all series of a dict of hosts, each a dict of metric
+        names mapping to lists of (time, value) rows. This is the
+        structure of os-metric.json.
+        """
+        for host, metrics in os_metric.items():
+            for metric, rows in metrics.items():
+                self.append(host, metric, rows)
+
+    def flush(self):
+        self.data_fd.flush()
+        self.index_fd.flush()
+
+    def close(self):
+        self.data_fd.close()
+        self.index_fd.close()
+
+class MetricStore:
+    """
+    Read access to the metric store in datadir. The data file is
+    memory mapped and only the index is parsed when opening it.
+    """
+    def __init__(self, datadir):
+        import numpy
+
+        header, self.chunks = read_index(datadir)
+        dtype = numpy.dtype(numpy.float64).newbyteorder(
+                '<' if header['byteorder'] == 'little' else '>')
+        nrows = max([end for chunks in self.chunks.values()
+                     for start, end in chunks], default = 0)
+        if nrows > 0:
+            self.data = numpy.memmap(os.path.join(datadir, DATA_FNAME),
+                                     dtype = dtype, mode = 'r',
+                                     shape = (nrows, 2))
+        else:
+            self.data = numpy.empty((0, 2), dtype = dtype)
+
+    def hosts(self):
+        """
+        Return the list of hosts in the store.
+        """
+        return sorted(set([host for host, metric in self.chunks]))
+
+    def series_names(self):
+        """
+        Return the list of (host, metric) tuples of all series.
+        """
+        return list(self.chunks)
+
+    def series(self, host, metric):
+        """
+        Return the (rows, 2) float64 array of the time and value of a
+        series, ordered by time. A series written in one chunk is
+        returned as a read-only view of the memory map.
+        """
+        import numpy
+
+        chunks = self.chunks[(host, metric)]
+        if len(chunks) == 1:
+            start, end = chunks[0]
+            return self.data[start:end]
+        data = numpy.concatenate([self.data[start:end]
+                                  for start, end in chunks])
+        if (data[1:, 0] < data[:-1, 0]).any():
+            data = data[numpy.argsort(data[:, 0], kind = 'stable')]
+        return data
+
+if __name__ == '__main__':
+    sys.exit(main())
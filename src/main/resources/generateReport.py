@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
 
+import sys
 import generateReport
-generateReport.main.main()
+sys.exit(generateReport.main.main())
@@ -1,3 +1,4 @@
 from . import bmsqlResult
+from . import bmsqlMergedResult
 from . import bmsqlPlot
 from . import main
@@ -0,0 +1,140 @@
+import numpy
+
+from generateReport import *
+
+class bmsqlMergedResult(bmsqlResult.bmsqlResult):
+    """
+    The combined result of several BenchmarkSQL runs that drove the
+    same database at the same time from multiple app nodes. It has the
+    same interface as bmsqlResult, so reports can be generated from it
+    as from a single result.
+
+    The result.csv seconds and OS metric timestamps of every node are
+    relative to the start of its own run. The runs must have been
+    started together for the merged time series to line up.
+    """
+    # ----
+    # How the runInfo columns of the nodes are combined. Columns not
+    # listed here are taken from the first result.
+    # ----
+    RUNINFO_MAX = ['rampupMins', 'runMins', 'loadWarehouses', 'runWarehouses']
+    RUNINFO_SUM = ['numSUTThreads', 'maxDeliveryBGThreads']
+
+    def __init__(self, resdirs, use_cache = True):
+        """
+        Load all the results in resdirs and merge them.
+        """
+        self.resdirs = list(resdirs)
+        self.results = [bmsqlResult.bmsqlResult(resdir, use_cache = use_cache)
+                        for resdir in self.resdirs]
+        self.ttypes = self.results[0].ttypes
+        self._merge()
+
+    def update(self):
+        """
+        Update all the results and merge them again. Returns the total
+        number of new result.csv rows.
+        """
+        num_new = sum([result.update() for result in self.results])
+        self._merge()
+        return num_new
+
+    def _merge(self):
+        results = self.results
+
+        # ----
+        # The run info
+        # ----
+        self.runinfo = dict(results[0].runinfo)
+        self.runinfo['runID'] = '+'.join([r.runinfo['runID'] for r in results])
+        for key in self.RUNINFO_MAX:
+            self.runinfo[key] = str(max([int(r.runinfo[key]) for r in results]))
+        for key in self.RUNINFO_SUM:
+            self.runinfo[key] = str(sum([int(r.runinfo[key]) for r in results]))
+
+        # ----
+        # The result.csv rows of all nodes, in order of time, and the
+        # interval histograms. Both are only ever summed up per time
+        # interval, so the rows of the nodes can simply be combined.
+        # ----
+        self.result_ttype = {}
+        self.interval_hist_ttype = {}
+        for tt in self.ttypes:
+            rows = numpy.concatenate([r.result_ttype[tt] for r in results])
+            order = numpy.argsort(rows['second'], kind = 'stable')
+            self.result_ttype[tt] = rows[order]
+            self.interval_hist_ttype[tt] = numpy.concatenate(
+                    [r.interval_hist_ttype[tt] for r in results])
+
+        # ----
+        # The summary data only exists once all runs have finished.
+        # ----
+        if not all([hasattr(r, 'summary_ttype') for r in results]):
+            return
+
+        # ----
+        # All nodes use the same histogram buckets, so merging them
+        # is adding up the counts. The percentiles calculated from
+        # the merged histogram are those of all transactions.
+        # ----
+        self.hist_ttype = {}
+        for tt in self.ttypes:
+            hist = results[0].hist_ttype[tt].copy()
+            for r in results[1:]:
+                hist['numtrans'] += r.hist_ttype[tt]['numtrans']
+            self.hist_ttype[tt] = hist
+        self.hist_bins = results[0].hist_bins
+        self.hist_cutoff = results[0].hist_cutoff
+        self.hist_statsdiv = results[0].hist_statsdiv
+        self.hist_cdf = {tt: numpy.cumsum(hist['numtrans'])
+                         for tt, hist in self.hist_ttype.items()}
+
+        # ----
+        # The summary rows are count, percent, mean, max, rollbacks
+        # and errors. The mean is weighted by the count of every node
+        # and the percentage recalculated from the combined counts.
+        # ----
+        self.summary_ttype = {}
+        for tt in self.ttypes:
+            rows = [r.summary_ttype[tt] for r in results]
+            count = sum([row[0] for row in rows])
+            if count > 0:
+                mean = sum([row[0] * row[2] for row in rows]) / count
+            else:
+                mean = 0.0
+            self.summary_ttype[tt] = [
+                    count,
+                    0.0,
+                    mean,
+                    max([row[3] for row in rows]),
+                    sum([row[4] for row in rows]),
+                    sum([row[5] for row in rows]),
+                ]
+        self.total_trans = (sum([self.summary_ttype[tt][0]
+                                for tt in self.ttypes])
+                                - self.summary_ttype['DELIVERY_BG'][0])
+        for tt in self.ttypes:
+            if tt != 'DELIVERY_BG' and self.total_trans > 0:
+                self.summary_ttype[tt][1] = (self.summary_ttype[tt][0]
+                                             / self.total_trans * 100.0)
+
+        self.os_metric = bmsqlResult.OSMetric(self._os_metric_index,
+                                              self._os_metric_series)
+
+        self.properties = '\n'.join(["# ---- {} ----\n{}".format(resdir, r.properties)
+                                     for resdir, r in zip(self.resdirs, results)])
+
+    def _os_metric_index(self):
+        # ----
+        # OS metrics of the same host collected by more than one node
+        # are only taken from the first.
+        # ----
+        self._os_metric_host = {}
+        for r in self.results:
+            for host in r.os_metric:
+                self._os_metric_host.setdefault(host, r.os_metric[host])
+        return {host: list(metrics)
+                for host, metrics in self._os_metric_host.items()}
+
+    def _os_metric_series(self, host, metric):
+        return self._os_metric_host[host][metric]
@@ -4,7 +4,6 @@ import io
 import csv
 import base64
 import numpy
-import warnings
 import matplotlib.pyplot as pyplot
 from mpl_toolkits.axes_grid1 import Divider, Size
 from mpl_toolkits.axes_grid1.mpl_axes import Axes
@@ -12,9 +11,74 @@ import json
 
 from generateReport import *
 
+class TimeBuckets:
+    """
+    Group time series samples into fixed intervals (buckets) and reduce
+    the values per bucket in one vectorized pass.
+
+    The X vector is the sorted unique bucket start times in elapsed
+    minutes (offset by rampup). If x is given, samples that do not fall
+    into one of those buckets are ignored and buckets without samples
+    reduce to NaN.
+    """
+    def __init__(self, seconds, offset, interval = 10, x = None):
+        seconds = numpy.asarray(seconds, dtype = numpy.float64)
+        minutes = (numpy.trunc(seconds / interval) * interval - offset) / 60
+
+        if x is None:
+            self.x = numpy.unique(minutes)
+        else:
+            self.x = numpy.asarray(x, dtype = numpy.float64)
+
+        # ----
+        # Find the bucket index of every sample and bring the samples
+        # into bucket order (stable, so that the order within a bucket
+        # stays the same).
+        # ----
+        idx = numpy.searchsorted(self.x, minutes)
+        valid = idx < len(self.x)
+        valid[valid] = self.x[idx[valid]] == minutes[valid]
+        self.select = numpy.flatnonzero(valid)
+        idx = idx[self.select]
+        order = numpy.argsort(idx, kind = 'stable')
+        self.select = self.select[order]
+        idx = idx[order]
+
+        # ----
+        # Every bucket that has samples starts where the index changes.
+        # ----
+        self.starts = numpy.flatnonzero(numpy.diff(idx, prepend = -1))
+        self.present = idx[self.starts]
+        self.count = numpy.zeros(len(self.x))
+        self.count[self.present] = numpy.diff(self.starts, append = len(idx))
+
+    def _reduce(self, ufunc, values):
+        values = numpy.asarray(values, dtype = numpy.float64)[self.select]
+        result = numpy.full(len(self.x), numpy.nan)
+        if len(values) > 0:
+            result[self.present] = ufunc.reduceat(values, self.starts)
+        return result
+
+    def sum(self, values):
+        return self._reduce(numpy.add, values)
+
+    def max(self, values):
+        return self._reduce(numpy.maximum, values)
+
+    def mean(self, values):
+        with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+            return self.sum(values) / self.count
+
 class bmsqlPlot:
     FIGSIZE = [10, 2.5]
 
+    # ----
+    # A fixed salt for the SVG element IDs and no date in the metadata
+    # make the SVG output reproducible. The same chart is then byte
+    # identical no matter in which process or order it was rendered.
+    # ----
+    SVG_HASHSALT = 'BenchmarkSQL'
+
     def __init__(self, result):
         self.result = result
         self.data = {}
@@ -55,18 +119,14 @@ class bmsqlPlot:
         # to an interval.
         # ----
         interval = 10
-        data = numpy.array([[(int(tup[0] / interval) * interval - offset)
-                           / 60, tup[1] * (60 / interval)]
-                           for tup in result.result_ttype['NEW_ORDER']])
-        x = sorted(numpy.unique(data[:,0]))
+        data = result.result_ttype['NEW_ORDER']
+        buckets = TimeBuckets(data['second'], offset, interval)
+        x = buckets.x
 
         # ----
         # The Y vector is the sums of transactions grouped by X
         # ----
-        y = []
-        for ts in x:
-            tmp = data[numpy.where(data[:,0] == ts)]
-            y.append(numpy.sum(tmp[:,1]))
+        y = buckets.sum(data['numtrans'] * (60 / interval))
 
         # ----
         # Plot the NOPM and add all the decorations
@@ -77,12 +137,7 @@ class bmsqlPlot:
         plt.set_ylabel("tpmC")
         plt.grid()
 
-        buf = io.StringIO()
-        pyplot.savefig(buf, format = 'svg')
-
-        if not b64encode:
-            return buf.getvalue()
-        return base64.b64encode(buf.getvalue().encode('utf-8')).decode('utf-8')
+        return self._svg_output(fig, b64encode)
 
     def delay_avg_svg(self, ttype, b64encode = True):
         max_ms = self.result.percentile(ttype, 0.99) * 1100.0
@@ -122,23 +177,17 @@ class bmsqlPlot:
         # to an interval.
         # ----
         interval = 10
-        data = numpy.array([[(int(tup[0] / interval) * interval - offset) / 60,
-                           tup[1], tup[5]]
-                           for tup in result.result_ttype[ttype]])
-        x = sorted(numpy.unique(data[:,0]))
+        data = result.result_ttype[ttype]
+        buckets = TimeBuckets(data['second'], offset, interval)
+        x = buckets.x
+        numtrans = buckets.sum(data['numtrans']) + 0.000001
 
         # ----
         # The Y vector is the sums of transactions delay divided by
         # the sums of the count, grouped by X.
         # ----
-        y = []
-        for ts in x:
-            tmp = data[numpy.where(data[:,0] == ts)]
-            ms = numpy.sum(tmp[:,2]) / (numpy.sum(tmp[:,1]) + 0.000001)
-            if ms <= max_ms:
-                y.append(ms)
-            else:
-                y.append(max_ms)
+        ms = buckets.sum(data['sumdelayms']) / numtrans
+        y = numpy.where(ms <= max_ms, ms, max_ms)
 
         # ----
         # Plot the ttype delay and add all the decorations
@@ -148,21 +197,8 @@ class bmsqlPlot:
         # ----
         # Now do the same aggregation for the latency
         # ----
-        data = numpy.array([[(int(tup[0] / interval) * interval - offset) / 60,
-                           tup[1], tup[2]]
-                           for tup in result.result_ttype[ttype]])
-
-        # ----
-        # The Y vector is similar by based on latency
-        # ----
-        y = []
-        for ts in x:
-            tmp = data[numpy.where(data[:,0] == ts)]
-            ms = numpy.sum(tmp[:,2]) / (numpy.sum(tmp[:,1]) + 0.000001)
-            if ms <= max_ms:
-                y.append(ms)
-            else:
-                y.append(max_ms)
+        ms = buckets.sum(data['sumlatencyms']) / numtrans
+        y = numpy.where(ms <= max_ms, ms, max_ms)
         plt.plot(x, y, 'b', label = 'Latency')
 
         plt.set_title("{} Average Latency and Delay".format(ttype))
@@ -171,12 +207,7 @@ class bmsqlPlot:
         plt.legend(loc = 'upper left')
         plt.grid()
 
-        buf = io.StringIO()
-        pyplot.savefig(buf, format = 'svg')
-
-        if not b64encode:
-            return buf.getvalue()
-        return base64.b64encode(buf.getvalue().encode('utf-8')).decode('utf-8')
+        return self._svg_output(fig, b64encode)
 
     def delay_max_svg(self, ttype, b64encode = True):
         max_ms = self.result.percentile(ttype, 0.99) * 1500.0
@@ -215,22 +246,15 @@ class bmsqlPlot:
         # to an interval.
         # ----
         interval = 10
-        data = numpy.array([[(int(tup[0] / interval) * interval - offset) / 60,
-                           tup[4], tup[7]]
-                           for tup in result.result_ttype[ttype]])
-        x = sorted(numpy.unique(data[:,0]))
+        data = result.result_ttype[ttype]
+        buckets = TimeBuckets(data['second'], offset, interval)
+        x = buckets.x
 
         # ----
-        # The Y vector for delay is the max of data[2]
+        # The Y vector for delay is the max of maxdelayms
         # ----
-        y = []
-        for ts in x:
-            tmp = data[numpy.where(data[:,0] == ts)]
-            ms = numpy.max(tmp[:,2])
-            if ms <= max_ms:
-                y.append(ms)
-            else:
-                y.append(max_ms)
+        ms = buckets.max(data['maxdelayms'])
+        y = numpy.where(ms <= max_ms, ms, max_ms)
 
         # ----
         # Plot the ttype delay and add all the decorations
@@ -238,16 +262,10 @@ class bmsqlPlot:
         plt.plot(x, y, 'r', label = 'Delay')
 
         # ----
-        # The Y vector for latency is the same on data[1]
+        # The Y vector for latency is the same on maxlatencyms
         # ----
-        y = []
-        for ts in x:
-            tmp = data[numpy.where(data[:,0] == ts)]
-            ms = numpy.max(tmp[:,1])
-            if ms <= max_ms:
-                y.append(ms)
-            else:
-                y.append(max_ms)
+        ms = buckets.max(data['maxlatencyms'])
+        y = numpy.where(ms <= max_ms, ms, max_ms)
         plt.plot(x, y, 'b', label = 'Latency')
 
         plt.set_title("{} Maximum Latency and Delay".format(ttype))
@@ -256,12 +274,58 @@ class bmsqlPlot:
         plt.legend(loc = 'upper left')
         plt.grid()
 
-        buf = io.StringIO()
-        pyplot.savefig(buf, format = 'svg')
+        return self._svg_output(fig, b64encode)
 
-        if not b64encode:
-            return buf.getvalue()
-        return base64.b64encode(buf.getvalue().encode('utf-8')).decode('utf-8')
+    def latency_percentiles_svg(self, ttype, b64encode = True):
+        fig = pyplot.figure(figsize = self.FIGSIZE)
+
+        h = [Size.Fixed(1.2), Size.Scaled(1.), Size.Fixed(.2)]
+        v = [Size.Fixed(0.7), Size.Scaled(1.), Size.Fixed(.5)]
+
+        divider = Divider(fig, (0.0, 0.0, 1., 1.), h, v, aspect=False)
+        plt = Axes(fig, divider.get_position())
+        plt.set_axes_locator(divider.new_locator(nx=1, ny=1))
+
+        fig.add_axes(plt)
+
+        result = self.result
+        runinfo = result.runinfo
+
+        # ----
+        # The X limits are -rampupMins, runMins
+        # ----
+        plt.set_xlim(-int(runinfo['rampupMins']), int(runinfo['runMins']))
+        plt.axvspan(-int(runinfo['rampupMins']), 0,
+                    facecolor = '0.2', alpha = 0.1)
+
+        # ----
+        # offset the timestamps by -rampupMins so that the graph
+        # starts with negative minutes elapsed and switches to
+        # positive when the measurement begins.
+        # ----
+        offset = (int(runinfo['rampupMins'])) * 60.0
+
+        # ----
+        # ttype latency percentiles per minute from the interval
+        # histograms. Unlike the other latency charts these are not
+        # capped, since the spikes are what we want to see here.
+        # ----
+        interval = 60
+        seconds, pct = result.interval_percentiles(ttype,
+                                                   [0.5, 0.9, 0.99],
+                                                   interval)
+        x = (seconds - offset) / 60
+        plt.plot(x, pct[:, 0] * 1000.0, 'g', label = '50th %')
+        plt.plot(x, pct[:, 1] * 1000.0, 'b', label = '90th %')
+        plt.plot(x, pct[:, 2] * 1000.0, 'r', label = '99th %')
+
+        plt.set_title("{} Latency Percentiles per Minute".format(ttype))
+        plt.set_xlabel("Elapsed Minutes")
+        plt.set_ylabel("Latency in ms")
+        plt.legend(loc = 'upper left')
+        plt.grid()
+
+        return self._svg_output(fig, b64encode)
 
     def metric_svg(self, host = None, title = "undefined",
                    ylabel = "undefined", metrics = [], b64encode = True):
@@ -309,16 +373,7 @@ class bmsqlPlot:
         plt.legend(loc = 'upper left')
         plt.grid()
 
-        # ----
-        # Now turn this into an in-memory SVG and return it as requested
-        # (raw or b64-encoded)
-        # ----
-        buf = io.StringIO()
-        pyplot.savefig(buf, format = 'svg')
-
-        if not b64encode:
-            return buf.getvalue()
-        return base64.b64encode(buf.getvalue().encode('utf-8')).decode('utf-8')
+        return self._svg_output(fig, b64encode)
 
     def cpu_svg(self, host = None, title = "CPU Usage", ylabel = "Percent",
                b64encode = True):
@@ -405,16 +460,7 @@ class bmsqlPlot:
         plt.legend(loc = 'upper left')
         plt.grid()
 
-        # ----
-        # Now turn this into an in-memory SVG and return it as requested
-        # (raw or b64-encoded)
-        # ----
-        buf = io.StringIO()
-        pyplot.savefig(buf, format = 'svg')
-
-        if not b64encode:
-            return buf.getvalue()
-        return base64.b64encode(buf.getvalue().encode('utf-8')).decode('utf-8')
+        return self._svg_output(fig, b64encode)
 
     def memory_svg(self, host = None, title = "Memory Usage",
                unit = "Bytes", factor = 1.0, b64encode = True):
@@ -487,16 +533,7 @@ class bmsqlPlot:
         plt.legend(loc = 'upper left')
         plt.grid()
 
-        # ----
-        # Now turn this into an in-memory SVG and return it as requested
-        # (raw or b64-encoded)
-        # ----
-        buf = io.StringIO()
-        pyplot.savefig(buf, format = 'svg')
-
-        if not b64encode:
-            return buf.getvalue()
-        return base64.b64encode(buf.getvalue().encode('utf-8')).decode('utf-8')
+        return self._svg_output(fig, b64encode)
 
     def _get_metric_tree(self, m, x = None):
         if m['op'] == 'VAL':
@@ -505,7 +542,7 @@ class bmsqlPlot:
         elif m['op'] == 'ADD':
             x, y1 = self._get_metric_tree(m['lval'], x)
             _, y2 = self._get_metric_tree(m['rval'], x)
-            return x, [l + r for l, r in zip(y1, y2)]
+            return x, y1 + y2
         else:
             raise Exception("Unknown operand '{}'".format(m['op']))
 
@@ -522,21 +559,24 @@ class bmsqlPlot:
             m['factor'] = 1.0
 
         interval = 10
-        data = numpy.array([[(int(tup[0] / interval) * interval - offset) / 60,
-                             (tup[1] or 0.0) * m['factor']]
-                   for tup in self.result.os_metric[m['host']][m['metric']]])
+        data = self.result.os_metric[m['host']][m['metric']]
+
+        buckets = TimeBuckets(data[:,0], offset, interval, x)
+        x = buckets.x
+        y = buckets.mean(data[:,1] * m['factor'])
 
-        if x is None:
-            x = sorted(numpy.unique(data[:,0]))
-
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", category=RuntimeWarning)
-            y = []
-            for ts in x:
-                tmp = data[numpy.where(data[:,0] == ts)]
-                y.append(numpy.mean(tmp[:,1]))
-        
-        #print("data for metric", m)
-        #print("x:", x)
-        #print("y:", y)
         return x, y
+
+    def _svg_output(self, fig, b64encode = True):
+        """
+        Turn the figure into an in-memory SVG and return it as requested
+        (raw or b64-encoded). The figure is closed afterwards.
+        """
+        buf = io.StringIO()
+        with pyplot.rc_context({'svg.hashsalt': self.SVG_HASHSALT}):
+            fig.savefig(buf, format = 'svg', metadata = {'Date': None})
+        pyplot.close(fig)
+
+        if not b64encode:
+            return buf.getvalue()
+        return base64.b64encode(buf.getvalue().encode('utf-8')).decode('utf-8')
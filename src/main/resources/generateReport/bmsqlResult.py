@@ -1,11 +1,66 @@
 import os.path
+import io
 import csv
 import math
 import json
 import re
+import collections.abc
+import numpy
+
+import bmsqlMetricStore
 
 class bmsqlResult:
-    def __init__(self, resdir):
+    # ----
+    # Column layout of the CSV files that have one row per transaction
+    # type and time (result.csv) or histogram bucket (histogram.csv).
+    # The ttype column itself is not part of the per ttype rows. It is
+    # kept separately as a small integer code.
+    # ----
+    RESULT_COLUMNS = [
+            ('second',          numpy.int64),
+            ('numtrans',        numpy.int64),
+            ('sumlatencyms',    numpy.int64),
+            ('minlatencyms',    numpy.int64),
+            ('maxlatencyms',    numpy.int64),
+            ('sumdelayms',      numpy.int64),
+            ('mindelayms',      numpy.int64),
+            ('maxdelayms',      numpy.int64),
+        ]
+    HISTOGRAM_COLUMNS = [
+            ('edge',            numpy.float64),
+            ('numtrans',        numpy.int64),
+        ]
+
+    # ----
+    # interval_histogram.csv has the latency histogram of every result
+    # interval, with lines only for the buckets that are not empty.
+    # Each bucket covers INTERVAL_BUCKET_SIZE buckets of histogram.csv.
+    # jTPCC uses HIST_STATSDIV = ln(STATS_CUTOFF * 1000) / NUM_BUCKETS.
+    # ----
+    INTERVAL_HISTOGRAM_COLUMNS = [
+            ('second',          numpy.int64),
+            ('bucket',          numpy.int64),
+            ('numtrans',        numpy.int64),
+        ]
+    INTERVAL_BUCKET_SIZE = 10
+    HIST_STATSDIV = math.log(600.0 * 1000.0) / 1000
+
+    # ----
+    # The parsed data is cached in binary form (numpy .npy files that
+    # can be memory mapped) in data/cache. A cached file is only used
+    # if the version and the size and mtime of its source file match
+    # what is recorded in the cache manifest.
+    # ----
+    CACHE_DIR = 'cache'
+    CACHE_VERSION = 2
+
+    # ----
+    # The CSV files are parsed in blocks of about this many bytes, so
+    # that only one block of text is in memory at a time.
+    # ----
+    CSV_BLOCK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, resdir, use_cache = True):
         """
         Create a new bmsqlResult instance and load all the data
         in the result directory.
@@ -20,6 +75,9 @@ class bmsqlResult:
             ]
         self.resdir = resdir
         self.datadir = os.path.join(resdir, 'data')
+        self.cachedir = os.path.join(self.datadir, self.CACHE_DIR)
+        self.use_cache = use_cache
+        self._row_buf = {}
 
         # ----
         # Load the run info into a dict
@@ -32,7 +90,20 @@ class bmsqlResult:
         # ----
         # Load the other CSV files into dicts of arrays.
         #
-        #   result_ttype    a dict of result_data slices by transaction type
+        #   result_ttype    a dict of result.csv rows (structured numpy
+        #                   arrays) by transaction type
+        #
+        #   result_offset   the number of bytes of result.csv that have
+        #                   been loaded so far
+        #
+        #   interval_hist_ttype
+        #                   a dict of interval_histogram.csv rows by
+        #                   transaction type (empty for results of older
+        #                   versions that don't have the file)
+        #
+        #   interval_hist_offset
+        #                   the number of bytes of interval_histogram.csv
+        #                   that have been loaded so far
         #
         #   summary_ttype   a dict of transaction summary info per type
         #
@@ -42,19 +113,104 @@ class bmsqlResult:
         #
         #   hist_cutoff     the edge of the last bin in the histogram
         #
+        #   hist_cdf        a dict of the cumulative transaction counts
+        #                   over the histogram bins by transaction type
+        #
         # Loading of the summary will fail if the benchmark run is
         # still in progress or has been aborted. We then return with
         # an incoplete result, which still allows drawing graphs.
+        # update() can be called later to load only the new result
+        # rows, and the summary once the run is finished.
         # ----
-        self.result_ttype = self._load_ttype_csv_multiple('result.csv')
+        self.result_ttype, self.result_offset = self._load_ttype_csv_multiple(
+                'result.csv', self.RESULT_COLUMNS)
+        if os.path.exists(os.path.join(self.datadir, 'interval_histogram.csv')):
+            self.interval_hist_ttype, self.interval_hist_offset = \
+                    self._load_ttype_csv_multiple('interval_histogram.csv',
+                                                  self.INTERVAL_HISTOGRAM_COLUMNS)
+        else:
+            self.interval_hist_ttype = {tt: numpy.empty(0,
+                    dtype = self.INTERVAL_HISTOGRAM_COLUMNS) for tt in self.ttypes}
+            self.interval_hist_offset = 0
+        self._load_summary()
+
+    def update(self):
+        """
+        Incrementally load the rows appended to result.csv and
+        interval_histogram.csv since the last load or update. Once the
+        benchmark run has finished, the summary data is loaded as well.
+        Returns the number of new result.csv rows.
+        """
+        self.result_ttype, self.result_offset, num_new = \
+                self._update_ttype_csv('result.csv', self.RESULT_COLUMNS,
+                                       self.result_ttype, self.result_offset)
+        if os.path.exists(os.path.join(self.datadir, 'interval_histogram.csv')):
+            self.interval_hist_ttype, self.interval_hist_offset, _ = \
+                    self._update_ttype_csv('interval_histogram.csv',
+                                           self.INTERVAL_HISTOGRAM_COLUMNS,
+                                           self.interval_hist_ttype,
+                                           self.interval_hist_offset)
+
+        if not hasattr(self, 'summary_ttype'):
+            self._load_summary()
+        return num_new
+
+    def _update_ttype_csv(self, fname, columns, ttdict, offset):
+        """
+        Append the rows of fname after offset to the per ttype arrays
+        in ttdict. Returns the new ttdict and offset and the number of
+        new rows.
+        """
+        path = os.path.join(self.datadir, fname)
+        if os.stat(path).st_size < offset:
+            # The file was replaced by a shorter one. Start over.
+            ttdict, offset = self._load_ttype_csv_multiple(fname, columns)
+            for ttype in self.ttypes:
+                self._row_buf.pop((fname, ttype), None)
+            return ttdict, offset, sum([len(rows) for rows in ttdict.values()])
+
+        raw, offset = self._parse_ttype_csv(fname, columns, offset)
+        for code, ttype in enumerate(self.ttypes):
+            self._append_rows(fname, ttdict, ttype, raw[raw['ttype'] == code])
+        return ttdict, offset, len(raw)
+
+    def _append_rows(self, fname, ttdict, ttype, raw):
+        """
+        Append rows to ttdict[ttype]. The rows are kept in a buffer
+        that grows by doubling its size, so that ttdict only ever
+        holds views and appending is amortized O(1) per row.
+        """
+        if len(raw) == 0:
+            return
+        buf = self._row_buf.get((fname, ttype))
+        used = len(ttdict[ttype])
+        if buf is None or used + len(raw) > len(buf):
+            buf = numpy.empty(max(2 * len(ttdict[ttype]),
+                                  used + len(raw), 1024),
+                              dtype = ttdict[ttype].dtype)
+            buf[:used] = ttdict[ttype]
+            self._row_buf[(fname, ttype)] = buf
+        for name in buf.dtype.names:
+            buf[name][used:used + len(raw)] = raw[name]
+        ttdict[ttype] = buf[:used + len(raw)]
+
+    def _load_summary(self):
+        """
+        Load the summary, histogram, OS metric and properties data.
+        This fails silently if the benchmark run is still in progress
+        or has been aborted.
+        """
         try:
             self.summary_ttype = self._load_ttype_csv_single('summary.csv')
         except StopIteration:
             return
-        self.hist_ttype = self._load_ttype_csv_multiple('histogram.csv')
+        self.hist_ttype, _ = self._load_ttype_csv_multiple(
+                'histogram.csv', self.HISTOGRAM_COLUMNS)
         self.hist_bins = len(self.hist_ttype['NEW_ORDER'])
         self.hist_cutoff = self.hist_ttype['NEW_ORDER'][-1][0]
         self.hist_statsdiv = math.log(self.hist_cutoff * 1000.0) / self.hist_bins
+        self.hist_cdf = {tt: numpy.cumsum(hist['numtrans'])
+                         for tt, hist in self.hist_ttype.items()}
 
         # ----
         # The total number of "measured" transactions is the sum summary
@@ -65,19 +221,24 @@ class bmsqlResult:
                                 - self.summary_ttype['DELIVERY_BG'][0])
 
         # ----
-        # If an OS metric collector was running, load its data.
+        # If an OS metric collector was running, make its data
+        # available. Nothing is read until the report actually uses
+        # it. Older collectors wrote os-metric.json instead of the
+        # metric store.
         # ----
-        os_metric_fname = os.path.join(self.datadir, 'os-metric.json')
-        if os.path.exists(os_metric_fname):
-            with open(os_metric_fname) as fd:
-                self.os_metric = json.loads(fd.read())
+        if bmsqlMetricStore.exists(self.datadir):
+            self.os_metric = OSMetric(self._metric_store_index,
+                                      self._metric_store_series)
+        elif os.path.exists(os.path.join(self.datadir, 'os-metric.json')):
+            self.os_metric = OSMetric(self._os_metric_index,
+                                      self._os_metric_series)
         else:
             self.os_metric = {}
 
         # ----
         # Load the run.properties but remove the password
         # ----
-        prop_fname = os.path.join(resdir, 'run.properties')
+        prop_fname = os.path.join(self.resdir, 'run.properties')
         with open(prop_fname, 'r') as fd:
             props = fd.read()
         self.properties = re.sub(r'(password\s*=\s*).*$', r'\1********',
@@ -94,14 +255,72 @@ class bmsqlResult:
         """
         Returns the nth percentile response time of transaction type tt
         """
-        nth_have = 0
-        nth_need = int(self.summary_ttype[tt][0] * nth)
-        b = 0
-        for b in range(0, self.hist_bins):
-            if nth_have >= nth_need:
-                break
-            nth_have += int(self.hist_ttype[tt][b][1])
-        return math.exp(float(b) * self.hist_statsdiv) / 1000.0
+        return float(self.percentiles(tt, [nth])[0])
+
+    def percentiles(self, tt, nths):
+        """
+        Returns an array of the nths percentile response times (in
+        seconds) of transaction type tt.
+        """
+        return self._hist_percentiles(self.hist_cdf[tt], nths,
+                                      self.hist_statsdiv, 1)
+
+    def interval_percentiles(self, tt, nths, interval = 60):
+        """
+        Returns the nths percentile response times (in seconds) of
+        transaction type tt over time. The interval histograms are
+        merged into intervals of the given number of seconds. The
+        result is a tuple of the start second of every interval that
+        has transactions and an array with one row of percentiles per
+        interval.
+        """
+        data = self.interval_hist_ttype[tt]
+        nths = numpy.asarray(nths, dtype = numpy.float64)
+        nbins = int(data['bucket'].max()) + 1 if len(data) > 0 else 1
+
+        # ----
+        # Sum up the counts into a dense (interval, bucket) matrix.
+        # ----
+        seconds, row = numpy.unique(data['second'] // interval,
+                                    return_inverse = True)
+        counts = numpy.zeros((len(seconds), nbins), dtype = numpy.int64)
+        numpy.add.at(counts, (row, data['bucket']), data['numtrans'])
+
+        cdf = numpy.cumsum(counts, axis = 1)
+        result = numpy.empty((len(seconds), len(nths)))
+        for i in range(len(seconds)):
+            result[i] = self._hist_percentiles(cdf[i], nths,
+                                               self.HIST_STATSDIV,
+                                               self.INTERVAL_BUCKET_SIZE)
+        return seconds * interval, result
+
+    def _hist_percentiles(self, cdf, nths, statsdiv, size):
+        """
+        Returns the nths percentiles (in seconds) of the histogram with
+        the cumulative counts cdf.
+
+        jTPCC puts a latency of L ms into bin round(ln(L) / statsdiv),
+        so bin k covers the latencies from exp((k - 0.5) * statsdiv)
+        to exp((k + 0.5) * statsdiv) and bin 0 everything below that.
+        Here every bin covers size of those. The bin holding a
+        percentile is found by binary search in the cumulative counts.
+        Inside of it we interpolate linearly on the log scale, in bin 0
+        linearly from 0.
+        """
+        nths = numpy.asarray(nths, dtype = numpy.float64)
+        if len(cdf) == 0 or cdf[-1] == 0:
+            return numpy.zeros(nths.shape)
+
+        need = nths * cdf[-1]
+        b = numpy.searchsorted(cdf, need, side = 'left')
+        b = numpy.minimum(b, len(cdf) - 1)
+        below = numpy.where(b > 0, cdf[b - 1], 0)
+        count = cdf[b] - below
+        frac = numpy.clip((need - below) / numpy.maximum(count, 1), 0.0, 1.0)
+
+        upper = numpy.exp(((b + frac) * size - 0.5) * statsdiv)
+        bin0 = frac * math.exp((size - 0.5) * statsdiv)
+        return numpy.where(b > 0, upper, bin0) / 1000.0
 
     def num_trans(self, tt):
         """
@@ -149,8 +368,15 @@ class bmsqlResult:
         Read a CSV file that has the transaction type as the first element.
         We expect a single row per transaction type.
         """
+        cached = self._cache_load(fname)
+        if cached is not None:
+            arrays, _ = cached
+            return {self.ttypes[code]: [float(d) for d in row]
+                    for code, row in zip(arrays['ttype'], arrays['values'])}
+
         ttdict = {}
         path = os.path.join(self.datadir, fname)
+        stat = os.stat(path)
         with open(path, newline = '') as fd:
             rdr = csv.reader(fd)
             if skip_header:
@@ -159,24 +385,343 @@ class bmsqlResult:
                 tt = row[0]
                 ttdict[tt] = [float(d) for d in row[1:]]
 
+        ttypes = [tt for tt in self.ttypes if tt in ttdict]
+        self._cache_save(fname, stat, {
+                'ttype': numpy.array([self.ttypes.index(tt) for tt in ttypes],
+                                     dtype = numpy.int8),
+                'values': numpy.array([ttdict[tt] for tt in ttypes],
+                                      dtype = numpy.float64),
+            })
+
         return ttdict
 
-    def _load_ttype_csv_multiple(self, fname, skip_header = True):
+    def _load_ttype_csv_multiple(self, fname, columns):
         """
-        Read a CSV file that has the transaction type as the first element.
-        Return a list of tuples as well as a dict that has lists of tuples
-        separated by transaction type.
+        Read a CSV file that has the transaction type as the first element
+        and numeric columns as described by columns after that.
+
+        The file is parsed in a single pass into a structured numpy array
+        with the transaction type encoded as a small integer. The rows are
+        then (stable) sorted by that code so that the rows of every
+        transaction type are contiguous. Returns a dict of views into
+        that array, one per transaction type, and the number of bytes
+        of the file that were loaded.
         """
+        cached = self._cache_load(fname)
+        if cached is not None:
+            arrays, meta = cached
+            data = arrays['data']
+            bounds = arrays['bounds']
+            offset = meta['offset']
+        else:
+            stat = os.stat(os.path.join(self.datadir, fname))
+            raw, offset = self._parse_ttype_csv(fname, columns)
+
+            # ----
+            # Sort by transaction type and drop the ttype column so that
+            # the per ttype rows have the same layout as the CSV file
+            # minus the first column.
+            # ----
+            order = numpy.argsort(raw['ttype'], kind = 'stable')
+            ttcode = raw['ttype'][order]
+            data = numpy.empty(len(raw), dtype = numpy.dtype(columns))
+            for name, _ in columns:
+                data[name] = raw[name][order]
+            bounds = numpy.searchsorted(ttcode,
+                                        numpy.arange(len(self.ttypes) + 1))
+
+            self._cache_save(fname, stat, {'data': data, 'bounds': bounds},
+                             {'offset': offset})
+
         ttdict = {}
+        for code, ttype in enumerate(self.ttypes):
+            ttdict[ttype] = data[bounds[code]:bounds[code + 1]]
+
+        return ttdict, offset
+
+    def _parse_ttype_csv(self, fname, columns, offset = 0):
+        """
+        Parse the complete lines of a CSV file with the transaction type
+        as the first element, starting at byte offset (0 means the file
+        starts with a header line). A trailing partial line of a file
+        that is still being written is left for the next call. Returns
+        a structured array with a ttype code column in addition to
+        columns, and the offset after the last parsed line.
+        """
+        blocks = []
+        with open(os.path.join(self.datadir, fname), 'rb') as fd:
+            fd.seek(offset)
+            if offset == 0:
+                header = fd.readline()
+                if not header.endswith(b'\n'):
+                    return self._parse_ttype_csv_block(b'', columns), 0
+                offset = len(header)
+
+            # ----
+            # Read the file in blocks, each cut after its last complete
+            # line. The next block starts right after that line. Only a
+            # line longer than a whole block makes us read more at once.
+            # ----
+            size = self.CSV_BLOCK_SIZE
+            while True:
+                buf = fd.read(size)
+                end = buf.rfind(b'\n') + 1
+                if end == 0:
+                    if len(buf) < size:
+                        break
+                    fd.seek(-len(buf), 1)
+                    size *= 2
+                    continue
+                fd.seek(end - len(buf), 1)
+                blocks.append(self._parse_ttype_csv_block(buf[:end], columns))
+                offset += end
+
+        if len(blocks) == 0:
+            return self._parse_ttype_csv_block(b'', columns), offset
+        if len(blocks) == 1:
+            return blocks[0], offset
+        return numpy.concatenate(blocks), offset
+
+    def _parse_ttype_csv_block(self, buf, columns):
+        """
+        Parse a block of complete CSV lines. The transaction type names
+        are looked up in the sorted name table for all rows at once,
+        unknown names get the code -1.
+        """
+        names = numpy.array(self.ttypes, dtype = 'S{}'.format(
+                            max([len(tt) for tt in self.ttypes]) + 1))
+        name_order = numpy.argsort(names)
+        sorted_names = names[name_order]
+
+        # ----
+        # The ttype code is written into the first byte of the parsed
+        # name, so the result is a view of the parsed rows with the
+        # code in place of the name, not a copy.
+        # ----
+        text_dtype = numpy.dtype([('ttype', names.dtype)] + columns)
+        dtype = numpy.dtype({
+                'names': ['ttype'] + [name for name, _ in columns],
+                'formats': [numpy.int8] + [fmt for _, fmt in columns],
+                'offsets': [text_dtype.fields[name][1]
+                            for name in text_dtype.names],
+                'itemsize': text_dtype.itemsize,
+            })
+        if len(buf) == 0:
+            return numpy.empty(0, dtype = dtype)
+
+        text = numpy.loadtxt(io.StringIO(buf.decode('utf-8')),
+                             delimiter = ',', dtype = text_dtype, ndmin = 1)
+        idx = numpy.minimum(numpy.searchsorted(sorted_names, text['ttype']),
+                            len(sorted_names) - 1)
+        codes = numpy.where(sorted_names[idx] == text['ttype'],
+                            name_order[idx], -1)
+        raw = text.view(dtype)
+        raw['ttype'] = codes
+        return raw
+
+    def _metric_store_index(self):
+        """
+        Open the metric store written by the OS metric collectors and
+        return a dict of hosts, each a list of metric names.
+        """
+        self._metric_store = bmsqlMetricStore.MetricStore(self.datadir)
+        index = {}
+        for host, metric in self._metric_store.series_names():
+            index.setdefault(host, []).append(metric)
+        return index
+
+    def _metric_store_series(self, host, metric):
+        """
+        Return the (second, value) rows of one series of the metric
+        store. They are memory mapped unless the series has missing
+        values (NaN), which are turned into 0.0.
+        """
+        data = self._metric_store.series(host, metric)
+        if numpy.isnan(data[:,1]).any():
+            data = numpy.nan_to_num(data)
+        return data
+
+    def _os_metric_index(self):
+        """
+        Load os-metric.json and return a dict of hosts, each a list of
+        metric names.
+        """
+        self._os_metric_values, self._os_metric_rows = \
+                self._load_os_metric('os-metric.json')
+        return {host: list(metrics)
+                for host, metrics in self._os_metric_rows.items()}
+
+    def _os_metric_series(self, host, metric):
+        """
+        Return the (second, value) rows of one series of os-metric.json.
+        """
+        start, end = self._os_metric_rows[host][metric]
+        return self._os_metric_values[start:end]
+
+    def _load_os_metric(self, fname):
+        """
+        Read the os-metric.json file written by the OS metric collectors.
+        Returns one array with the (second, value) rows of all series
+        and a dict of hosts, each a dict of metric names mapping to the
+        (start, end) rows of the series in that array. Missing values
+        (null) are turned into 0.0.
+
+        With a valid cache entry only the index is parsed and the rows
+        are memory mapped.
+        """
+        cached = self._cache_load(fname)
+        if cached is not None:
+            arrays, index = cached
+            return arrays['values'], index
+
         path = os.path.join(self.datadir, fname)
-        with open(path, newline = '') as fd:
-            rdr = csv.reader(fd)
-            if skip_header:
-                _ = next(rdr)
-            data = [[row[0], [float(d) for d in row[1:]]] for row in rdr]
+        stat = os.stat(path)
+        with open(path) as fd:
+            os_metric = json.loads(fd.read())
 
-            for ttype in self.ttypes:
-                tuples = filter(lambda x : x[0] == ttype, data)
-                ttdict[ttype] = [tup[1] for tup in tuples]
+        # ----
+        # Concatenate all series into one array of rows and remember
+        # where each one starts and ends.
+        # ----
+        index = {}
+        series = []
+        nrows = 0
+        for host, metrics in os_metric.items():
+            index[host] = {}
+            for metric, data in metrics.items():
+                index[host][metric] = (nrows, nrows + len(data))
+                series.append(numpy.array([(t, v or 0.0) for t, v in data],
+                                          dtype = numpy.float64).reshape(-1, 2))
+                nrows += len(data)
+        if len(series) > 0:
+            values = numpy.concatenate(series)
+        else:
+            values = numpy.empty((0, 2), dtype = numpy.float64)
 
-        return ttdict
+        self._cache_save(fname, stat, {'values': values}, index)
+
+        return values, index
+
+    def _cache_load(self, fname):
+        """
+        Return the cached arrays and metadata for the data file fname
+        or None if there is no valid cache entry for it. The arrays are
+        memory mapped read-only.
+        """
+        if not self.use_cache:
+            return None
+        try:
+            with open(os.path.join(self.cachedir, 'manifest.json')) as fd:
+                manifest = json.loads(fd.read())
+            entry = manifest['files'][fname]
+            stat = os.stat(os.path.join(self.datadir, fname))
+            if (manifest['version'] != self.CACHE_VERSION
+                    or entry['size'] != stat.st_size
+                    or entry['mtime_ns'] != stat.st_mtime_ns):
+                return None
+            arrays = {}
+            for name in entry['arrays']:
+                arrays[name] = numpy.load(
+                        os.path.join(self.cachedir,
+                                     '{}.{}.npy'.format(fname, name)),
+                        mmap_mode = 'r')
+        except (OSError, ValueError, KeyError):
+            return None
+        return arrays, entry['meta']
+
+    def _cache_save(self, fname, stat, arrays, meta = None):
+        """
+        Save the arrays parsed from the data file fname into the cache.
+        stat is the os.stat() result of the source taken before parsing
+        it. Failure to write the cache (like a read-only archive) is not
+        an error.
+        """
+        if not self.use_cache:
+            return
+        manifest_path = os.path.join(self.cachedir, 'manifest.json')
+        try:
+            os.makedirs(self.cachedir, exist_ok = True)
+            for name, array in arrays.items():
+                path = os.path.join(self.cachedir,
+                                    '{}.{}.npy'.format(fname, name))
+                with open(path + '.tmp', 'wb') as fd:
+                    numpy.save(fd, array)
+                os.replace(path + '.tmp', path)
+
+            # ----
+            # The manifest is updated last, so that a partially written
+            # cache entry is never considered valid.
+            # ----
+            try:
+                with open(manifest_path) as fd:
+                    manifest = json.loads(fd.read())
+                if manifest['version'] != self.CACHE_VERSION:
+                    raise ValueError("cache version mismatch")
+            except (OSError, ValueError, KeyError):
+                manifest = {'version': self.CACHE_VERSION, 'files': {}}
+            manifest['files'][fname] = {
+                    'size': stat.st_size,
+                    'mtime_ns': stat.st_mtime_ns,
+                    'arrays': list(arrays.keys()),
+                    'meta': meta,
+                }
+            with open(manifest_path + '.tmp', 'w') as fd:
+                fd.write(json.dumps(manifest))
+            os.replace(manifest_path + '.tmp', manifest_path)
+        except OSError:
+            pass
+
+class OSMetric(collections.abc.Mapping):
+    """
+    The OS metric data of a result as a read-only dict of hosts, each a
+    dict of metric names mapping to an array of (second, value) rows.
+
+    load_index() is called on first access and must return a dict of
+    hosts, each a list of metric names. load_series(host, metric) is
+    called on the first access of every series.
+    """
+    def __init__(self, load_index, load_series):
+        self._load_index = load_index
+        self._load_series = load_series
+        self._index = None
+        self._hosts = {}
+
+    def _get_index(self):
+        if self._index is None:
+            self._index = self._load_index()
+        return self._index
+
+    def __getitem__(self, host):
+        if host not in self._hosts:
+            self._hosts[host] = OSMetricHost(host, self._get_index()[host],
+                                             self._load_series)
+        return self._hosts[host]
+
+    def __iter__(self):
+        return iter(self._get_index())
+
+    def __len__(self):
+        return len(self._get_index())
+
+class OSMetricHost(collections.abc.Mapping):
+    """
+    The metrics of one host in OSMetric.
+    """
+    def __init__(self, host, metrics, load_series):
+        self._host = host
+        self._metrics = metrics
+        self._load_series = load_series
+        self._series = {}
+
+    def __getitem__(self, metric):
+        if metric not in self._series:
+            if metric not in self._metrics:
+                raise KeyError(metric)
+            self._series[metric] = self._load_series(self._host, metric)
+        return self._series[metric]
+
+    def __iter__(self):
+        return iter(self._metrics)
+
+    def __len__(self):
+        return len(self._metrics)
@@ -1,16 +1,20 @@
 #!/usr/bin/env python3
 
 import os
+import re
 import sys
+import glob
+import time
 import jinja2
 import base64
 import getopt
+import concurrent.futures
 
 from generateReport import *
 
 def main():
     opt_template = 'report_simple.html'
-    opt_resultdir = None
+    opt_resultdirs = []
     opt_os_metrics = []
     opt_tt_limit = {
         'NEW_ORDER':    5.0,
@@ -20,18 +24,21 @@ def main():
         'DELIVERY':     5.0,
         'DELIVERY_BG': 80.0
     }
+    opt_use_cache = True
+    opt_merge = None
+    opt_jobs = os.cpu_count() or 1
     opt_help = False
     errors = False
 
-    opts, args = getopt.getopt(sys.argv[1:], 't:r:l:c:m:d:i:h?',
+    opts, args = getopt.getopt(sys.argv[1:], 't:r:l:c:m:d:i:j:M:h?',
             ['template=', 'resultdir=', 'limit=',
              'cpu=', 'memory=', 'disk=', 'interface=',
-             'help'])
+             'jobs=', 'merge=', 'no-cache', 'help'])
     for opt, val in opts:
         if opt in ['-t', '--template',]:
             opt_template = val
         elif opt in ['-r', '--resultdir',]:
-            opt_resultdir = val
+            opt_resultdirs.append(val)
         elif opt in ['-l', '--limit',]:
             sval = val.split('=')
             if len(sval) != 2:
@@ -93,18 +100,129 @@ def main():
                 errors = True
                 continue
             opt_os_metrics.append(('interface', sval[0], sval[1], sval[2]))
+        elif opt in ['-j', '--jobs',]:
+            try:
+                opt_jobs = int(val)
+            except Exception as e:
+                print("invalid number of jobs: {}".format(str(e)),
+                      file = sys.stderr)
+                errors = True
+                continue
+        elif opt in ['-M', '--merge',]:
+            opt_merge = val
+        elif opt in ['--no-cache',]:
+            opt_use_cache = False
         elif opt in ['-?', '-h', '--help']:
             opt_help = True
             break
 
+    # ----
+    # Result directories can also be given as arguments and all of
+    # them can be glob patterns. A directory matched more than once is
+    # only used the first time, so that no two jobs write the same
+    # report.
+    # ----
+    resultdirs = []
+    seen = set()
+    for pattern in opt_resultdirs + args:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+        else:
+            matches = [pattern]
+        for resultdir in matches:
+            realpath = os.path.realpath(resultdir)
+            if realpath not in seen:
+                seen.add(realpath)
+                resultdirs.append(resultdir)
+
     if errors:
         return 2
-    if opt_help or opt_resultdir is None:
+    if opt_help or len(resultdirs) == 0:
         usage()
         return 2
 
-    result = bmsqlResult.bmsqlResult(opt_resultdir)
-    result.tt_limit = opt_tt_limit
+    # ----
+    # With --merge the results of all the app nodes that ran against
+    # the same database are combined into one report.
+    # ----
+    if opt_merge is not None:
+        reportFname, _ = generate_merged_report(resultdirs, opt_merge,
+                                                opt_template, opt_os_metrics,
+                                                opt_tt_limit, opt_use_cache,
+                                                opt_jobs)
+        print("merged report of {} results generated as {}".format(
+              len(resultdirs), reportFname))
+        return 0
+
+    # ----
+    # A single result is rendered in this process, using the jobs
+    # for rendering the charts in parallel.
+    # ----
+    if len(resultdirs) == 1:
+        reportFname, _ = generate_report(resultdirs[0], opt_template,
+                                         opt_os_metrics, opt_tt_limit,
+                                         opt_use_cache, opt_jobs)
+        print("report generated as {}".format(reportFname))
+        return 0
+
+    # ----
+    # Batch mode: the jobs are used to generate the reports for many
+    # results in parallel, each rendering its charts serially. Every
+    # worker process sets up the Jinja environment and compiles the
+    # template once when it starts, whatever the start method.
+    # ----
+    timings = {}
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers = max(1, min(opt_jobs, len(resultdirs))),
+            initializer = _report_worker_init,
+            initargs = (opt_template,)) as pool:
+        futures = {
+            pool.submit(generate_report, resultdir, opt_template,
+                        opt_os_metrics, opt_tt_limit, opt_use_cache, 1):
+                resultdir
+            for resultdir in resultdirs
+        }
+        for future in concurrent.futures.as_completed(futures):
+            resultdir = futures[future]
+            try:
+                reportFname, timings[resultdir] = future.result()
+                print("report generated as {}".format(reportFname))
+            except Exception as e:
+                print("{}: {}".format(resultdir, str(e)), file = sys.stderr)
+                timings[resultdir] = None
+                failed += 1
+
+    # ----
+    # Print the timing summary in the order the results were given.
+    # ----
+    width = max([len(resultdir) for resultdir in resultdirs])
+    print("")
+    print("{:<{}}  {:>8}  {:>8}  {:>8}".format('result', width,
+          'load', 'render', 'total'))
+    for resultdir in resultdirs:
+        if timings[resultdir] is None:
+            print("{:<{}}  FAILED".format(resultdir, width))
+            continue
+        load, render = timings[resultdir]
+        print("{:<{}}  {:>7.2f}s  {:>7.2f}s  {:>7.2f}s".format(resultdir,
+              width, load, render, load + render))
+    print("{} reports generated, {} failed".format(
+          len(resultdirs) - failed, failed))
+    if failed > 0:
+        return 1
+    return 0
+
+def generate_report(resultdir, template, os_metrics, tt_limit,
+                    use_cache = True, jobs = 1):
+    """
+    Load the result in resultdir and write the report for it next to
+    the result directory. Returns the report file name and a tuple of
+    the load and the render time in seconds.
+    """
+    start = time.time()
+    result = bmsqlResult.bmsqlResult(resultdir, use_cache = use_cache)
+    result.tt_limit = tt_limit
     for tt in result.ttypes:
         break
         print("count {} = {}".format(tt, result.num_trans(tt)))
@@ -116,16 +234,54 @@ def main():
                 result.num_rollbacks(tt) / result.num_trans(tt) * 100))
         print("errors {} = {}".format(tt, result.num_errors(tt)))
         print("")
+    loaded = time.time()
+
+    reportFname = resultdir.rstrip('/\\') + '.html'
+    with open(reportFname, 'w') as fd:
+        fd.write(generate_html(result, template, os_metrics, jobs = jobs))
+    return reportFname, (loaded - start, time.time() - loaded)
+
+def _report_worker_init(template):
+    jinja_env().get_template(template)
+
+def generate_merged_report(resultdirs, reportFname, template, os_metrics,
+                           tt_limit, use_cache = True, jobs = 1):
+    """
+    Load the results in resultdirs, merge them and write the report
+    of the combined result as reportFname. Returns the report file name
+    and a tuple of the load and the render time in seconds.
+    """
+    start = time.time()
+    result = bmsqlMergedResult.bmsqlMergedResult(resultdirs,
+                                                 use_cache = use_cache)
+    result.tt_limit = tt_limit
+    loaded = time.time()
 
-    reportFname = opt_resultdir.rstrip('/\\') + '.html'
     with open(reportFname, 'w') as fd:
-        fd.write(generate_html(result, opt_template, opt_os_metrics))
-    print("report generated as {}".format(reportFname))
+        fd.write(generate_html(result, template, os_metrics, jobs = jobs))
+    return reportFname, (loaded - start, time.time() - loaded)
+
+_jinja_env = None
+
+def jinja_env():
+    """
+    Return the Jinja environment for the report templates. It is only
+    created once per process so that its template cache is reused.
+    """
+    global _jinja_env
+    if _jinja_env is None:
+        _jinja_env = jinja2.Environment(
+            loader = jinja2.PackageLoader('generateReport', 'templates')
+        )
+    return _jinja_env
 
-def generate_html(result, template, os_metrics):
-    env = jinja2.Environment(
-        loader = jinja2.PackageLoader('generateReport', 'templates')
-    )
+def generate_html(result, template, os_metrics, jobs = 1):
+    """
+    Render the report template for result. With jobs > 1 the charts
+    are rendered in a pool of that many worker processes. Otherwise
+    they are rendered serially while the template is rendered.
+    """
+    env = jinja_env()
 
     plot = bmsqlPlot.bmsqlPlot(result)
 
@@ -146,6 +302,9 @@ def generate_html(result, template, os_metrics):
         'tpmc_svg': plot.tpmc_svg,
         'delay_avg_svg': plot.delay_avg_svg,
         'delay_max_svg': plot.delay_max_svg,
+        'latency_percentiles_svg': plot.latency_percentiles_svg,
+        'interval_hist': any([len(result.interval_hist_ttype[tt]) > 0
+                              for tt in result.ttypes]),
         'metric_svg': plot.metric_svg,
         'cpu_svg': plot.cpu_svg,
         'memory_svg': plot.memory_svg,
@@ -158,7 +317,73 @@ def generate_html(result, template, os_metrics):
             data['mix_warn'] = True
 
     template = env.get_template(template)
-    return template.render(**data)
+    if jobs <= 1:
+        return template.render(**data)
+
+    # ----
+    # Render the template with stand-ins for all the chart functions.
+    # They record the requested charts and return placeholders, which
+    # are then replaced with the charts rendered in parallel.
+    # ----
+    charts = []
+    for name in CHART_FUNCTIONS:
+        data[name] = ChartRecorder(name, charts)
+    html = template.render(**data)
+    svgs = render_charts(result, charts, jobs)
+    return CHART_PLACEHOLDER_RE.sub(lambda m: svgs[int(m.group(1))], html)
+
+# ----
+# The bmsqlPlot methods that templates call to embed charts and the
+# placeholder used for them when rendering charts in parallel.
+# ----
+CHART_FUNCTIONS = [
+    'tpmc_svg',
+    'delay_avg_svg',
+    'delay_max_svg',
+    'latency_percentiles_svg',
+    'metric_svg',
+    'cpu_svg',
+    'memory_svg',
+]
+CHART_PLACEHOLDER = '@@BMSQL_CHART_{}@@'
+CHART_PLACEHOLDER_RE = re.compile(r'@@BMSQL_CHART_(\d+)@@')
+
+class ChartRecorder:
+    """
+    Stand-in for a bmsqlPlot chart method during template rendering.
+    Every call is appended to charts as (name, args, kwargs) and a
+    placeholder for the chart is returned.
+    """
+    def __init__(self, name, charts):
+        self.name = name
+        self.charts = charts
+
+    def __call__(self, *args, **kwargs):
+        self.charts.append((self.name, args, kwargs))
+        return CHART_PLACEHOLDER.format(len(self.charts) - 1)
+
+def render_charts(result, charts, jobs):
+    """
+    Render the list of (name, args, kwargs) charts for result in a
+    process pool and return the b64-encoded SVGs in the same order.
+    """
+    if len(charts) == 0:
+        return []
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers = min(jobs, len(charts)),
+            initializer = _chart_worker_init,
+            initargs = (result,)) as pool:
+        return list(pool.map(_chart_worker_render, charts))
+
+_chart_worker_plot = None
+
+def _chart_worker_init(result):
+    global _chart_worker_plot
+    _chart_worker_plot = bmsqlPlot.bmsqlPlot(result)
+
+def _chart_worker_render(chart):
+    name, args, kwargs = chart
+    return getattr(_chart_worker_plot, name)(*args, **kwargs)
 
 def summary_data(result):
     color_ok = '#008000'
@@ -170,9 +395,8 @@ def summary_data(result):
         # ----
         # Determine the percentiles and the latency limit
         # ----
-        ninth = result.percentile(tt, 0.9)
-        n5th = result.percentile(tt, 0.95)
-        n9th = result.percentile(tt, 0.99)
+        n50th, ninth, n5th, n9th, n99th = result.percentiles(
+                tt, [0.5, 0.9, 0.95, 0.99, 0.999])
         limit = result.tt_limit[tt]
 
         # ----
@@ -182,6 +406,7 @@ def summary_data(result):
         color_ninth = color_ok
         color_n5th = color_ok
         color_n9th = color_ok
+        color_n99th = color_ok
         if ninth > limit:
             color_limit = color_error
             color_ninth = color_error
@@ -193,6 +418,8 @@ def summary_data(result):
             if ninth <= limit:
                 color_limit = color_warn
             color_n9th = color_warn
+        if n99th > limit:
+            color_n99th = color_warn
 
         # ----
         # Indicate if the transaction mix percentage is too low
@@ -235,13 +462,16 @@ def summary_data(result):
             'style_mix': 'style="color:{};"'.format(color_mix),
             'avg': "{:.3f}".format(result.avg_latency(tt)),
             'max': "{:.3f}".format(result.max_latency(tt)),
+            'n50th': "{:.3f}".format(n50th),
             'ninth': "{:.3f}".format(ninth),
             'n5th': "{:.3f}".format(n5th),
             'n9th': "{:.3f}".format(n9th),
+            'n99th': "{:.3f}".format(n99th),
             'limit': "{:.3f}".format(limit),
             'style_ninth': 'style="color:{};"'.format(color_ninth),
             'style_n5th': 'style="color:{};"'.format(color_n5th),
             'style_n9th': 'style="color:{};"'.format(color_n9th),
+            'style_n99th': 'style="color:{};"'.format(color_n99th),
             'style_limit': 'style="color:{};"'.format(color_limit),
             'rbk': rbk,
             'style_rbk': 'style="color:{};"'.format(color_rbk),
@@ -250,7 +480,8 @@ def summary_data(result):
     return data
 
 def usage():
-    sys.stderr.write("""usage: {} RESULT_DIR\n""".format(
+    sys.stderr.write("""usage: {0} [OPTIONS] -r RESULT_DIR [...]
+       {0} [OPTIONS] -M REPORT_FILE -r RESULT_DIR [...]\n""".format(
             os.path.basename(sys.argv[0])))
 
 if __name__ == '__main__':
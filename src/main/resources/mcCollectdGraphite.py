@@ -4,89 +4,91 @@
 #
 #   OS Metric collector script for BenchmarkSQL that retrieves data
 #   for selected hosts from a graphite-web instance and saves it in
-#   the os-metric.json file.
+#   the metric store (see bmsqlMetricStore.py).
 # ----------------------------------------------------------------------
-import os.path
 import sys
+import re
 import time
-import select
-import getopt
+import concurrent.futures
 
 import json
 import urllib.request
 import urllib.parse
 
-def main():
-    cargs = {
-        'url': 'http://localhost:8080',
-        'targets': [
-        ],
-        'startepoch': time.time(),
-    }
-
-    opts, args = getopt.getopt(sys.argv[1:], "u:t:r:S:", [
-            "url=", "target=", "resultdir=", "startepoch=",
-        ])
-    for opt, val in opts:
-        if opt in ['-u', '--url']:
-            cargs['url'] = val
-        elif opt in ['-t', '--target']:
-            cargs['targets'].append(val)
-        elif opt in ['-r', '--resultdir']:
-            cargs['resultdir'] = val
-        elif opt in ['-S', '--startepoch']:
-            cargs['startepoch'] = float(val)
+import mcCollector
 
-    coll = Collector(**cargs)
-
-    try:
-        coll.run()
-    except KeyboardInterrupt:
-        pass
+def main():
+    return mcCollector.main(Collector)
 
-    coll.shutdown()
+class Collector(mcCollector.Collector):
+    OPTIONS = [
+        ('u', 'url', 'url', str),
+        ('t', 'target', 'targets', list),
+        ('R', 'resolution', 'resolution', int),
+        ('w', 'workers', 'workers', int),
+    ]
 
-class Collector:
     def __init__(self, url = 'http://localhost:8080',
-                 targets = {}, resultdir = '.', startepoch = 0.0):
+                 targets = {}, resolution = 10, workers = 4, **kwargs):
+        super().__init__(**kwargs)
         self.url = url
         self.targets = targets
-        self.resultdir = resultdir
-        self.startepoch = float(startepoch)
-        self.starttime = time.time()
-
-        self.output = {}
-
-    def run(self):
-        # ----
-        # Run until we receive anything on stdin (which is the way the
-        # benchmark driver is signaling us to finish).
-        # ----
-        while True:
-            r, w, x = select.select([sys.stdin], [], [], None)
-            if len(r) > 0:
-                break
+        self.resolution = resolution
+        self.workers = workers
 
-    def shutdown(self):
+    def finish(self):
         # ----
         # On shutdown we retrieve the metric data from the
         # graphite server by calling the /render API with
-        # &format=json for all the targets specified.
+        # &format=json. Every target is fetched with its own request
+        # and the requests run in parallel. A failed request is
+        # reported, but we still save everything else we got.
         # ----
-        minutes = int((time.time() - self.starttime) / 60) + 1
-        params = urllib.parse.urlencode(
-                [('target', t) for t in self.targets] +
-                [('from', '-{}min'.format(minutes)), ('format', 'json')])
-        url = self.url + "?" + params
+        until = int(time.time()) + 1
+        result = {}
+        failed = 0
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers = self.workers) as pool:
+            futures = [pool.submit(self.render, target, until)
+                       for target in self.targets]
+            for future in futures:
+                try:
+                    gdata = future.result()
+                except Exception as ex:
+                    print(str(ex), file = sys.stderr)
+                    failed += 1
+                    continue
+                self.add_result(gdata, result)
+
+        self.save(result)
+        return failed
 
+    def render(self, target, until):
+        """
+        Retrieve the data of one target from startepoch to until.
+
+        With a resolution the series are summarized by graphite into
+        buckets of that many seconds. The buckets are aligned to
+        startepoch, like the ones of the report charts, so the report
+        gets exactly one value per bucket.
+        """
+        if self.resolution > 0:
+            target = 'summarize({}, "{}s", "avg", true)'.format(
+                    target, self.resolution)
+        params = urllib.parse.urlencode([
+                ('target', target),
+                ('from', int(self.startepoch)),
+                ('until', until),
+                ('format', 'json'),
+            ])
+        url = self.url + "?" + params
         try:
             with urllib.request.urlopen(url) as fd:
-                gdata = json.loads(fd.read().decode('utf-8'))
+                return json.loads(fd.read().decode('utf-8'))
         except Exception as ex:
-            print(str(ex), file = sys.stderr)
-            print("url was:", url)
-            return 1
+            raise Exception("{} (url was: {})".format(str(ex), url))
 
+    def add_result(self, gdata, result):
         # ----
         # We need to reformat the data slightly since the hostnames
         # in the graphite metric paths have '_' instead of '.' as
@@ -94,9 +96,8 @@ class Collector:
         # (value, timestamp) order, while we need that the other way
         # around.
         # ----
-        result = {}
         for entry in gdata:
-            esplit = entry['target'].split('.')
+            esplit = self.series_path(entry).split('.')
             host = esplit[1].replace('_', '.')
             metric = '.'.join(esplit[2:])
             if host not in result:
@@ -104,8 +105,23 @@ class Collector:
             result[host][metric] = [(t - self.startepoch, v)
                                     for v, t in entry['datapoints']]
 
-        with open(os.path.join(self.resultdir, 'os-metric.json'), 'w') as fd:
-            fd.write(json.dumps(result))
+    def series_path(self, entry):
+        """
+        Return the metric path of a series in the render output. The
+        target of a summarized series is the summarize() call. Newer
+        graphite versions have the original path in the name tag,
+        otherwise we take the first argument of the (nested) function
+        calls.
+        """
+        path = entry.get('tags', {}).get('name')
+        if path is not None:
+            return path
+        path = entry['target']
+        while True:
+            m = re.match(r'^\w+\((.*)\)$', path)
+            if m is None:
+                return path
+            path = m.group(1).split(',')[0].strip()
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
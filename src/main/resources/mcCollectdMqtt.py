@@ -5,70 +5,71 @@
 #   OS metric collector script for BenchmarkSQL that retrieves data
 #   sent to an MQTT broker by collectd on the server system(s)
 # ----------------------------------------------------------------------
-import os.path
 import sys
 import paho.mqtt.client as mqttc
-import csv
+import math
 import time
-import select
-import getopt
-import json
+import queue
+import threading
 
-def main():
-    cargs = {
-        'host': 'localhost',
-        'topics': [
-        ],
-        'startepoch': time.time(),
-    }
-
-    opts, args = getopt.getopt(sys.argv[1:], "h:p:U:P:t:r:i:S:", [
-            "host=", "port=", "user=", "password=", "topic=",
-            "resultdir=", "clientid=", "startepoch=",
-        ])
-    for opt, val in opts:
-        if opt in ['-h', '--host']:
-            cargs['host'] = val
-        elif opt in ['-p', '--port']:
-            cargs['port'] = val
-        elif opt in ['-U', '--user']:
-            cargs['user'] = val
-        elif opt in ['-P', '--password']:
-            cargs['password'] = val
-        elif opt in ['-t', '--topic']:
-            cargs['topics'].append(val)
-        elif opt in ['-r', '--resultdir']:
-            cargs['resultdir'] = val
-        elif opt in ['-i', '--clientid']:
-            cargs['clientId'] = val
-        elif opt in ['-s', '--startepoch']:
-            cargs['startepoch'] = float(val)
-
-    coll = Collector(**cargs)
-
-    try:
-        coll.run()
-    except KeyboardInterrupt:
-        pass
+import mcCollector
 
-    coll.shutdown()
+def main():
+    return mcCollector.main(Collector)
+
+class Collector(mcCollector.Collector):
+    OPTIONS = [
+        ('h', 'host', 'host', str),
+        ('p', 'port', 'port', str),
+        ('U', 'user', 'user', str),
+        ('P', 'password', 'password', str),
+        ('t', 'topic', 'topics', list),
+        ('i', 'clientid', 'clientId', str),
+        ('D', 'downsample', 'downsample', float),
+        ('F', 'flush-interval', 'flush_interval', float),
+    ]
 
-class Collector:
     def __init__(self, host = 'localhost', port = '1883',
                  clientId = None, user = None, password = None,
-                 topics = {}, resultdir = '.', startepoch = 0.0):
+                 topics = {}, downsample = 0, flush_interval = 60.0,
+                 **kwargs):
+        super().__init__(**kwargs)
         self.host = host
         self.port = int(port)
         self.clientId = clientId
         self.user = user
         self.password = password
         self.topics = topics
-        self.resultdir = resultdir
-        self.startepoch = float(startepoch)
+        self.downsample = downsample
+        self.flush_interval = flush_interval
 
-        self.result = {}
+        # ----
+        # The series by (topic, number of values), so that the topic
+        # of a message only needs to be parsed the first time.
+        # ----
+        self.topic_series = {}
+        self.next_flush = time.time() + self.flush_interval
+        self.bad_messages = 0
 
-        self.mqttc = mqttc.Client(self.clientId)
+        # ----
+        # The MQTT network loop runs in paho's background thread and
+        # only puts the received messages into the queue. They are
+        # processed (and flushed) by our own handler thread, so a slow
+        # flush never holds up the network loop.
+        # ----
+        self.queue = queue.SimpleQueue()
+        self.handler = threading.Thread(target = self.handle_messages,
+                                        daemon = True)
+
+        # ----
+        # paho-mqtt 2.x needs to be told that we use the original
+        # callback signatures.
+        # ----
+        if hasattr(mqttc, 'CallbackAPIVersion'):
+            self.mqttc = mqttc.Client(mqttc.CallbackAPIVersion.VERSION1,
+                                      self.clientId)
+        else:
+            self.mqttc = mqttc.Client(self.clientId)
         self.mqttc.on_connect = self.on_mqtt_connect
         self.mqttc.on_disconnect = self.on_mqtt_disconnect
         self.mqttc.on_message = self.on_mqtt_message
@@ -92,22 +93,70 @@ class Collector:
         pass
 
     def on_mqtt_message(self, client, userdata, msg):
+        """
+        Hand the message over to the handler thread
+        """
+        self.queue.put((msg.topic, msg.payload))
+
+    def handle_messages(self):
+        """
+        Handler thread main loop. Processes messages until it receives
+        None and flushes the series every flush_interval.
+        """
+        while True:
+            try:
+                item = self.queue.get(
+                        timeout = max(0.0, self.next_flush - time.time()))
+            except queue.Empty:
+                self.flush()
+                self.next_flush += self.flush_interval
+                continue
+            if item is None:
+                break
+            # ----
+            # A malformed message must not end the handler thread,
+            # everything received after it would be lost.
+            # ----
+            try:
+                self.handle_message(*item)
+            except Exception as e:
+                self.bad_messages += 1
+                print("ignoring bad message {} {!r}: {}".format(
+                      item[0], item[1][:80], str(e)), file = sys.stderr)
+
+    def handle_message(self, topic, payload):
         """
         Collect all metric data received for the specified topics
-        in self.result
+        in their series
         """
         # ----
-        # Extract the hostname and metric path from the topic
+        # Extract the timestamp adjusted by startepoch from the payload
         # ----
-        tl = msg.topic.split('/')
-        host = tl[1]
-        metrics = ['.'.join(tl[2:]),]
+        pl = payload.rstrip(b'\0').split(b':')
+        epoch = float(pl[0]) - self.startepoch
+
+        series = self.topic_series.get((topic, len(pl)))
+        if series is None:
+            series = self.new_series(topic, len(pl))
 
+        for i in range(0, len(series)):
+            try:
+                value = float(pl[i + 1])
+            except ValueError:
+                # collectd sends U for undefined values
+                value = math.nan
+            series[i].add(epoch, value)
+
+    def new_series(self, topic, num_values):
+        """
+        Create the series for a topic with num_values in the payload.
+        """
         # ----
-        # Extract the timestamp adjusted by startepoch from the payload
+        # Extract the hostname and metric path from the topic
         # ----
-        pl = msg.payload.decode('utf-8').rstrip('\0').split(':')
-        epoch = float(pl[0]) - self.startepoch
+        tl = topic.split('/')
+        host = tl[1]
+        metrics = ['.'.join(tl[2:]),]
 
         # ----
         # Some metrics sent by collectd actually have two values in them.
@@ -117,47 +166,49 @@ class Collector:
         # Having individual metric names simplifies the code in the
         # report generator.
         # ----
-        if metrics[0].startswith('disk-') and len(pl) == 3:
+        if metrics[0].startswith('disk-') and num_values == 3:
             metrics = [
                 '.'.join(tl[2:] + ['read']),
                 '.'.join(tl[2:] + ['write']),
             ]
-        elif metrics[0].startswith('interface-') and len(pl) == 3:
+        elif metrics[0].startswith('interface-') and num_values == 3:
             metrics = [
                 '.'.join(tl[2:] + ['rx']),
                 '.'.join(tl[2:] + ['tx']),
             ]
 
-        # ----
-        # Add the data to self.result
-        # ----
-        if host not in self.result:
-            self.result[host] = {}
-        for i in range(0, len(metrics)):
-            if metrics[i] not in self.result[host]:
-                self.result[host][metrics[i]] = []
-            self.result[host][metrics[i]].append([
-                    epoch, float(pl[i + 1])])
+        series = [self.get_series(host, metric, self.downsample)
+                  for metric in metrics]
+        self.topic_series[(topic, num_values)] = series
+        return series
 
     def run(self):
         # ----
-        # We call mqttc.loop() which will return after each event. We stop
-        # running when we receive any input on stdin (which is the way the
-        # benchmark driver is signaling us to finish).
+        # Start the MQTT network loop and the message handler in the
+        # background and wait for the end of the benchmark.
         # ----
-        while True:
-            self.mqttc.loop()
-            r, w, x = select.select([sys.stdin], [], [], 0.0)
-            if len(r) > 0:
-                break
+        self.handler.start()
+        self.mqttc.loop_start()
+        super().run()
 
-    def shutdown(self):
+    def finish(self):
         # ----
-        # On shutdown we dump all the collected data into the output file.
+        # Stop receiving messages. The handler thread processes
+        # everything that is still queued before it sees the None.
         # ----
+        self.mqttc.disconnect()
         self.mqttc.loop_stop()
-        with open(os.path.join(self.resultdir, 'os-metric.json'), 'w') as fd:
-            fd.write(json.dumps(self.result))
+        failed = 0
+        if self.handler.is_alive():
+            self.queue.put(None)
+            self.handler.join()
+        else:
+            print("the message handler has died", file = sys.stderr)
+            failed += 1
+        if self.bad_messages > 0:
+            print("{} bad messages were ignored".format(self.bad_messages),
+                  file = sys.stderr)
+        return failed
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,254 @@
+# ----------------------------------------------------------------------
+# mcCollector.py
+#
+#   Common base of the OS metric collector scripts for BenchmarkSQL.
+#
+#   A collector is a subclass of Collector, run by main(). main() does
+#   what OSCollector.java expects from a collector script. It parses
+#   the command line, runs the collector until stdin becomes readable
+#   (the driver closes it at the end of the benchmark), then shuts the
+#   collector down. All data is saved in the metric store (see
+#   bmsqlMetricStore.py), optionally also as os-metric.json.
+#
+#   A collector class defines its additional command line options in
+#   OPTIONS and then does one or more of:
+#
+#   finish()        Retrieve the data at the end of the run (from
+#                   a server that has been collecting it all along)
+#                   and pass it to save().
+#
+#   wakeup()        Called every wakeup_interval seconds while the
+#                   benchmark is running.
+#
+#   get_series()    Returns a Series buffer to add samples to as they
+#                   come in. The buffers are written to the store when
+#                   full, on flush() and on shutdown.
+# ----------------------------------------------------------------------
+import sys
+import math
+import time
+import select
+import getopt
+from array import array
+
+import bmsqlMetricStore
+
+def main(collector_class, argv = None):
+    """
+    Run collector_class as the OS metric collector of a benchmark and
+    return the exit code of the script.
+    """
+    options = [
+        ('r', 'resultdir', 'resultdir', str),
+        ('S', 'startepoch', 'startepoch', float),
+        (None, 'json', 'write_json', bool),
+    ] + collector_class.OPTIONS
+
+    shortopts = ''.join([short + ('' if otype is bool else ':')
+                         for short, long, name, otype in options
+                         if short is not None])
+    longopts = [long + ('' if otype is bool else '=')
+                for short, long, name, otype in options]
+    optmap = {}
+    for option in options:
+        if option[0] is not None:
+            optmap['-' + option[0]] = option
+        optmap['--' + option[1]] = option
+
+    cargs = {
+        'startepoch': time.time(),
+    }
+    for short, long, name, otype in options:
+        if otype is list:
+            cargs[name] = []
+
+    if argv is None:
+        argv = sys.argv[1:]
+    opts, args = getopt.getopt(argv, shortopts, longopts)
+    for opt, val in opts:
+        short, long, name, otype = optmap[opt]
+        if otype is list:
+            cargs[name].append(val)
+        elif otype is bool:
+            cargs[name] = True
+        else:
+            cargs[name] = otype(val)
+
+    coll = collector_class(**cargs)
+
+    try:
+        coll.run()
+    except KeyboardInterrupt:
+        pass
+
+    return coll.shutdown()
+
+def parse_duration(val):
+    """
+    Convert a Prometheus style duration like 10s, 1m or 2h into seconds.
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if val[-1:] in units:
+        return float(val[:-1]) * units[val[-1]]
+    return float(val)
+
+class Collector:
+    # ----
+    # Command line options in addition to -r/--resultdir,
+    # -S/--startepoch and --json. Every option is a tuple of
+    # (short option or None, long option, keyword argument, type).
+    # The type is applied to the value, list collects all values of
+    # a repeated option and bool makes it a flag without value.
+    # ----
+    OPTIONS = []
+
+    def __init__(self, resultdir = '.', startepoch = 0.0,
+                 write_json = False, wakeup_interval = None):
+        self.resultdir = resultdir
+        self.startepoch = float(startepoch)
+        self.write_json = write_json
+        self.wakeup_interval = wakeup_interval
+        self.starttime = time.time()
+
+        self.writer = bmsqlMetricStore.MetricStoreWriter(self.resultdir)
+        self.series = {}
+        if self.wakeup_interval is not None:
+            self.next_wakeup = time.time() + self.wakeup_interval
+
+    def run(self):
+        # ----
+        # Run until we receive anything on stdin (which is the way the
+        # benchmark driver is signaling us to finish). Without a
+        # wakeup_interval we sleep in select() until then.
+        # ----
+        while True:
+            if self.wakeup_interval is not None:
+                timeout = max(0.0, self.next_wakeup - time.time())
+            else:
+                timeout = None
+            r, w, x = select.select([sys.stdin], [], [], timeout)
+            if len(r) > 0:
+                break
+            self.wakeup()
+            # Skip the wakeups missed while wakeup() took too long
+            self.next_wakeup += self.wakeup_interval
+            now = time.time()
+            while self.next_wakeup <= now:
+                self.next_wakeup += self.wakeup_interval
+
+    def wakeup(self):
+        pass
+
+    def finish(self):
+        """
+        Called on shutdown to retrieve the data not collected yet.
+        Returns the number of failed requests.
+        """
+        return 0
+
+    def shutdown(self):
+        # ----
+        # On shutdown we let the collector finish, write all remaining
+        # data into the metric store and, if requested, export it as
+        # os-metric.json.
+        # ----
+        failed = self.finish()
+        self.flush(final = True)
+        self.writer.close()
+        if self.write_json:
+            bmsqlMetricStore.export_json(self.resultdir)
+
+        if failed > 0:
+            print("{} of the requests for metric data failed".format(failed),
+                  file = sys.stderr)
+            return 1
+        return 0
+
+    def save(self, result):
+        """
+        Save a dict of hosts, each a dict of metric names mapping to
+        lists of (second, value) rows, in the metric store.
+        """
+        self.writer.write_dict(result)
+
+    def get_series(self, host, metric, downsample = 0):
+        """
+        Return the Series buffer for a metric of a host.
+        """
+        series = self.series.get((host, metric))
+        if series is None:
+            series = Series(host, metric, self.writer, downsample)
+            self.series[(host, metric)] = series
+        return series
+
+    def flush(self, final = False):
+        """
+        Write the samples of all series to the metric store.
+        """
+        for series in self.series.values():
+            series.flush(final)
+        self.writer.flush()
+
+class Series:
+    """
+    The samples of one metric of one host that have not been written
+    to the metric store yet. They are kept in two preallocated typed
+    arrays, so a sample takes 16 bytes no matter how many we get.
+
+    With downsample the samples are averaged on ingest over buckets of
+    that many seconds, the same buckets the report uses for its charts.
+    """
+    CAPACITY = 256
+
+    def __init__(self, host, metric, writer, downsample = 0):
+        self.host = host
+        self.metric = metric
+        self.writer = writer
+        self.downsample = downsample
+        self.times = array('d', bytes(8 * self.CAPACITY))
+        self.values = array('d', bytes(8 * self.CAPACITY))
+        self.used = 0
+        self.bucket = None
+        self.bucket_sum = 0.0
+        self.bucket_count = 0
+
+    def add(self, epoch, value):
+        if self.downsample <= 0:
+            self._store(epoch, value)
+            return
+
+        bucket = math.trunc(epoch / self.downsample)
+        if bucket != self.bucket:
+            self._close_bucket()
+            self.bucket = bucket
+        if not math.isnan(value):
+            self.bucket_sum += value
+            self.bucket_count += 1
+
+    def _close_bucket(self):
+        if self.bucket_count > 0:
+            self._store(self.bucket * self.downsample,
+                        self.bucket_sum / self.bucket_count)
+        self.bucket_sum = 0.0
+        self.bucket_count = 0
+
+    def _store(self, epoch, value):
+        if self.used == self.CAPACITY:
+            self.flush()
+        self.times[self.used] = epoch
+        self.values[self.used] = value
+        self.used += 1
+
+    def flush(self, final = False):
+        """
+        Write the stored samples to the metric store. On the final
+        flush the current bucket is written as well, even if it is
+        not complete.
+        """
+        if final:
+            self._close_bucket()
+        if self.used > 0:
+            self.writer.append_columns(self.host, self.metric,
+                                       self.times[:self.used],
+                                       self.values[:self.used])
+            self.used = 0
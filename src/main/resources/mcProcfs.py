@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# ----------------------------------------------------------------------
+# mcProcfs.py
+#
+#   OS metric collector script for BenchmarkSQL that samples the
+#   /proc files of the local system directly. It needs neither
+#   collectd nor a metric server, but can only collect data of the
+#   machine it is running on.
+#
+#   The metric names are the same as those of collectd, so the report
+#   templates work with it unchanged.
+# ----------------------------------------------------------------------
+import sys
+import time
+import socket
+from array import array
+
+import mcCollector
+
+def main():
+    return mcCollector.main(Collector)
+
+class Source:
+    """
+    A /proc file that is opened once and read again for every sample
+    into the same buffer.
+    """
+    def __init__(self, path, size = 16384):
+        self.fd = open(path, 'rb', buffering = 0)
+        self.buf = bytearray(size)
+        self.used = 0
+
+    def read(self):
+        """
+        Read the current content of the file. Returns the buffer, the
+        content is buf[:used].
+        """
+        self.fd.seek(0)
+        self.used = 0
+        while True:
+            if self.used == len(self.buf):
+                self.buf.extend(bytes(len(self.buf)))
+            with memoryview(self.buf) as view:
+                n = self.fd.readinto(view[self.used:])
+            if n == 0:
+                return self.buf
+            self.used += n
+
+    def lines(self, skip = 0):
+        """
+        Read the file and yield the (start, end) positions of its lines
+        in the buffer, after the first skip lines. The lines are not
+        copied out of the buffer.
+        """
+        self.read()
+        pos = 0
+        while pos < self.used:
+            end = self.buf.find(b'\n', pos, self.used)
+            if end < 0:
+                end = self.used
+            if skip > 0:
+                skip -= 1
+            else:
+                yield pos, end
+            pos = end + 1
+
+    def value(self, key):
+        """
+        Return the number following key in the buffer, 0.0 if the file
+        does not have the key. Only that number is parsed.
+        """
+        pos = self.buf.find(key, 0, self.used)
+        if pos < 0:
+            return 0.0
+        pos += len(key)
+        end = self.buf.find(b'\n', pos, self.used)
+        if end < 0:
+            end = self.used
+        return float(self.buf[pos:end].split(None, 1)[0])
+
+    def close(self):
+        self.fd.close()
+
+class Counters:
+    """
+    The previous values of a set of monotonic counters, from which the
+    rates per second are calculated in place.
+    """
+    def __init__(self, size):
+        self.prev = array('d', bytes(8 * size))
+        self.rate = array('d', bytes(8 * size))
+        self.valid = False
+
+    def update(self, values, elapsed):
+        """
+        Store the new counter values and calculate the rates since the
+        last update. Returns False if there is no previous update or a
+        counter went backwards (reset or wrapped).
+        """
+        ok = self.valid and elapsed > 0
+        for i in range(len(self.prev)):
+            delta = values[i] - self.prev[i]
+            if delta < 0:
+                ok = False
+            self.rate[i] = delta / elapsed if elapsed > 0 else 0.0
+            self.prev[i] = values[i]
+        self.valid = True
+        return ok
+
+class Collector(mcCollector.Collector):
+    OPTIONS = [
+        ('H', 'hostname', 'hostname', str),
+        ('I', 'interval', 'interval', mcCollector.parse_duration),
+        ('d', 'disk', 'disks', list),
+        ('n', 'interface', 'interfaces', list),
+        ('F', 'flush-interval', 'flush_interval', float),
+    ]
+
+    # ----
+    # The /proc/stat cpu line has the jiffies spent in user, nice,
+    # system, idle, iowait, irq, softirq and steal, in that order.
+    # ----
+    CPU_STATES = ['user', 'nice', 'system', 'idle',
+                  'wait', 'interrupt', 'softirq', 'steal']
+
+    # ----
+    # The columns of /proc/diskstats (after major, minor and device
+    # name) and /proc/net/dev (after the interface name) that we turn
+    # into rates. The third element is the factor applied to the rate.
+    # Sectors are always 512 bytes, times are in milliseconds.
+    # ----
+    DISK_COUNTERS = [
+        ('disk_ops.read', 0, 1.0),
+        ('disk_merged.read', 1, 1.0),
+        ('disk_octets.read', 2, 512.0),
+        ('disk_io_time.read', 3, 0.001),
+        ('disk_ops.write', 4, 1.0),
+        ('disk_merged.write', 5, 1.0),
+        ('disk_octets.write', 6, 512.0),
+        ('disk_io_time.write', 7, 0.001),
+    ]
+    INTERFACE_COUNTERS = [
+        ('if_octets.rx', 0, 1.0),
+        ('if_packets.rx', 1, 1.0),
+        ('if_errors.rx', 2, 1.0),
+        ('if_dropped.rx', 3, 1.0),
+        ('if_octets.tx', 8, 1.0),
+        ('if_packets.tx', 9, 1.0),
+        ('if_errors.tx', 10, 1.0),
+        ('if_dropped.tx', 11, 1.0),
+    ]
+
+    # ----
+    # Without --disk or --interface all devices are collected except
+    # these.
+    # ----
+    IGNORE_DISKS = (b'loop', b'ram', b'zram')
+    IGNORE_INTERFACES = (b'lo', )
+
+    # ----
+    # The /proc/meminfo keys we use (in kB), including the newline of
+    # the line before, so that Cached doesn't match SwapCached. MemTotal
+    # is always the first line.
+    # ----
+    MEMINFO_KEYS = {
+        'total':    b'MemTotal:',
+        'free':     b'\nMemFree:',
+        'buffered': b'\nBuffers:',
+        'cached':   b'\nCached:',
+        'slab':     b'\nSlab:',
+    }
+
+    def __init__(self, hostname = None, interval = 10.0, disks = [],
+                 interfaces = [], flush_interval = 60.0, **kwargs):
+        super().__init__(wakeup_interval = interval, **kwargs)
+        if hostname is None:
+            hostname = socket.getfqdn()
+        self.hostname = hostname
+        self.interval = interval
+        self.disks = [disk.encode() for disk in disks]
+        self.interfaces = [interface.encode() for interface in interfaces]
+        self.flush_interval = flush_interval
+        self.next_flush = time.time() + self.flush_interval
+
+        self.stat = Source('/proc/stat')
+        self.meminfo = Source('/proc/meminfo')
+        self.diskstats = Source('/proc/diskstats')
+        self.netdev = Source('/proc/net/dev')
+
+        # ----
+        # The counters and series of every CPU, disk and interface
+        # are created on the first sample that has them.
+        # ----
+        self.cpu_counters = Counters(len(self.CPU_STATES))
+        self.cpu_series = [self.get_series(self.hostname,
+                                           'cpu.percent-' + state)
+                           for state in self.CPU_STATES]
+        self.mem_series = {
+            name: self.get_series(self.hostname, 'memory.memory-' + name)
+            for name in ['used', 'buffered', 'cached', 'free']
+        }
+        self.devices = {}
+        self.values = array('d', bytes(8 * 16))
+
+        # ----
+        # The first sample only sets the counters for the rates.
+        # ----
+        self.last_sample = time.time()
+        self.sample(self.last_sample, 0.0)
+
+    def wakeup(self):
+        now = time.time()
+        self.sample(now, now - self.last_sample)
+        self.last_sample = now
+        if now >= self.next_flush:
+            self.flush()
+            self.next_flush += self.flush_interval
+
+    def finish(self):
+        for source in [self.stat, self.meminfo, self.diskstats, self.netdev]:
+            source.close()
+        return 0
+
+    def sample(self, now, elapsed):
+        epoch = now - self.startepoch
+        self.sample_cpu(epoch, elapsed)
+        self.sample_memory(epoch)
+        self.sample_disks(epoch, elapsed)
+        self.sample_interfaces(epoch, elapsed)
+
+    def sample_cpu(self, epoch, elapsed):
+        # ----
+        # Only the first line (the sum over all CPUs) is used.
+        # ----
+        buf = self.stat.read()
+        fields = buf[:buf.find(b'\n', 0, self.stat.used)].split()[1:]
+        for i in range(len(self.CPU_STATES)):
+            self.values[i] = float(fields[i]) if i < len(fields) else 0.0
+        if not self.cpu_counters.update(self.values, elapsed):
+            return
+        total = sum(self.cpu_counters.rate)
+        if total <= 0:
+            return
+        for i in range(len(self.CPU_STATES)):
+            self.cpu_series[i].add(epoch,
+                                   self.cpu_counters.rate[i] / total * 100.0)
+
+    def sample_memory(self, epoch):
+        self.meminfo.read()
+        keys = self.MEMINFO_KEYS
+        free = self.meminfo.value(keys['free']) * 1024.0
+        buffered = self.meminfo.value(keys['buffered']) * 1024.0
+        cached = self.meminfo.value(keys['cached']) * 1024.0
+        slab = self.meminfo.value(keys['slab']) * 1024.0
+        # Like collectd we count neither cache nor slab as used
+        used = (self.meminfo.value(keys['total']) * 1024.0
+                - free - buffered - cached - slab)
+        self.mem_series['used'].add(epoch, used)
+        self.mem_series['buffered'].add(epoch, buffered)
+        self.mem_series['cached'].add(epoch, cached)
+        self.mem_series['free'].add(epoch, free)
+
+    def sample_disks(self, epoch, elapsed):
+        # ----
+        # A /proc/diskstats line is major, minor, device name and the
+        # counters.
+        # ----
+        buf = self.diskstats.buf
+        for start, end in self.diskstats.lines():
+            fields = buf[start:end].split()
+            if len(fields) < 3 + len(self.DISK_COUNTERS):
+                continue
+            self.sample_device(epoch, elapsed, 'disk-', fields[2], fields, 3,
+                               self.DISK_COUNTERS, self.disks,
+                               self.IGNORE_DISKS)
+
+    def sample_interfaces(self, epoch, elapsed):
+        # ----
+        # A /proc/net/dev line is the interface name, a colon and the
+        # counters. Large counters may follow the colon without a space.
+        # The first two lines are the header.
+        # ----
+        buf = self.netdev.buf
+        for start, end in self.netdev.lines(2):
+            colon = buf.find(b':', start, end)
+            if colon < 0:
+                continue
+            fields = buf[colon + 1:end].split()
+            if len(fields) <= self.INTERFACE_COUNTERS[-1][1]:
+                continue
+            self.sample_device(epoch, elapsed, 'interface-',
+                               buf[start:colon].strip(), fields, 0,
+                               self.INTERFACE_COUNTERS, self.interfaces,
+                               self.IGNORE_INTERFACES)
+
+    def sample_device(self, epoch, elapsed, prefix, name, fields, first_col,
+                      counters, only, ignore):
+        """
+        Add the rates of one device, unless it is excluded by only or
+        ignore.
+        """
+        if len(only) > 0:
+            if name not in only:
+                return
+        elif name.startswith(ignore):
+            return
+
+        name = bytes(name)
+        device = self.devices.get((prefix, name))
+        if device is None:
+            dname = prefix + name.decode()
+            device = (Counters(len(counters)),
+                      [self.get_series(self.hostname, dname + '.' + c[0])
+                       for c in counters])
+            self.devices[(prefix, name)] = device
+        dev_counters, dev_series = device
+
+        for i in range(len(counters)):
+            self.values[i] = float(fields[first_col + counters[i][1]])
+        if not dev_counters.update(self.values, elapsed):
+            return
+        for i in range(len(counters)):
+            dev_series[i].add(epoch, dev_counters.rate[i] * counters[i][2])
+
+if __name__ == '__main__':
+    sys.exit(main())
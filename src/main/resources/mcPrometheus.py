@@ -7,226 +7,413 @@
 # ----------------------------------------------------------------------
 import os.path
 import sys
+import re
+import math
 import time
-import select
-import getopt
+import threading
+import concurrent.futures
 
 import json
-import urllib.request
+import http.client
 import urllib.parse
 
+import mcCollector
+
 def main():
-    cargs = {
-        'url': 'http://localhost:8080',
-        'instances': [
-        ],
-        'startepoch': time.time() - 60,
-    }
-
-    opts, args = getopt.getopt(sys.argv[1:], "u:i:I:r:S:", [
-            "url=", "instance=", "interval=", "resultdir=", "startepoch=",
-        ])
-    for opt, val in opts:
-        if opt in ['-u', '--url']:
-            cargs['url'] = val
-        elif opt in ['-i', '--instance']:
-            cargs['instances'].append(val)
-        elif opt in ['-I', '--interval']:
-            cargs['interval'] = val
-        elif opt in ['-r', '--resultdir']:
-            cargs['resultdir'] = val
-        elif opt in ['-S', '--startepoch']:
-            cargs['startepoch'] = float(val) - 60
-
-    coll = Collector(**cargs)
-
-    try:
-        coll.run()
-    except KeyboardInterrupt:
-        pass
-
-    coll.shutdown()
-
-class Collector:
+    return mcCollector.main(Collector)
+
+class PrometheusAPI:
+    """
+    Minimal client for the Prometheus HTTP API. Every thread keeps
+    its own connection to the server alive between requests.
+    """
+    def __init__(self, url, timeout = 60.0):
+        parts = urllib.parse.urlsplit(url)
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.path = parts.path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            if self.scheme == 'https':
+                conn = http.client.HTTPSConnection(self.netloc,
+                                                   timeout = self.timeout)
+            else:
+                conn = http.client.HTTPConnection(self.netloc,
+                                                  timeout = self.timeout)
+            self.local.conn = conn
+        return conn
+
+    def get(self, params):
+        url = self.path + '?' + urllib.parse.urlencode(params)
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request('GET', url)
+                res = conn.getresponse()
+                body = res.read()
+                break
+            except (http.client.HTTPException, ConnectionError) as ex:
+                # ----
+                # The server may have closed the kept alive connection.
+                # Try once more with a new one.
+                # ----
+                conn.close()
+                self.local.conn = None
+                if attempt > 0:
+                    raise ex
+
+        try:
+            data = json.loads(body.decode('utf-8'))
+        except ValueError:
+            data = {'error': "HTTP {} {}".format(res.status, res.reason)}
+        if data.get('status') != 'success':
+            raise Exception("{} (url was: {})".format(data.get('error'), url))
+        return data['data']
+
+    def query_range(self, query, start, end, step):
+        return self.get({
+                "query": query,
+                "start": start,
+                "end": end,
+                "step": step,
+            })['result']
+
+class Collector(mcCollector.Collector):
+    OPTIONS = [
+        ('u', 'url', 'url', str),
+        ('i', 'instance', 'instances', list),
+        ('I', 'interval', 'interval', str),
+        ('w', 'workers', 'workers', int),
+        ('R', 'resolution', 'resolution', int),
+        ('P', 'pull-interval', 'pull_interval', mcCollector.parse_duration),
+    ]
+
+    # ----
+    # Prometheus refuses range queries that return more than 11,000
+    # points per series. We stay well below that with every chunk,
+    # which also makes the individual queries fast enough to run
+    # many of them in parallel.
+    # ----
+    CHUNK_POINTS = 1000
+
+    # ----
+    # Without an explicit --interval the step is the smallest of these
+    # that results in no more than --resolution points over the run.
+    # The range of irate() is never shorter than RATE_RANGE, so that
+    # it always covers at least two scrapes.
+    # ----
+    STEPS = [10, 15, 30, 60, 120, 300, 600, 900, 1800, 3600]
+    RATE_RANGE = 60
+
+    # ----
+    # With --pull-interval the data is retrieved while the benchmark
+    # is running. Every pull stops PULL_LAG seconds before the current
+    # time, so that Prometheus has scraped all targets up to there.
+    # ----
+    PULL_LAG = 60
+
+    # ----
+    # The rate metrics of disks and network interfaces. The first
+    # element is the name used in the metric store (after the device),
+    # the second the node_exporter metric.
+    # ----
+    DISK_METRICS = [
+        ['disk_octets.read', 'node_disk_read_bytes_total'],
+        ['disk_octets.write', 'node_disk_written_bytes_total'],
+        ['disk_ops.read', 'node_disk_reads_completed_total'],
+        ['disk_ops.write', 'node_disk_writes_completed_total'],
+        ['disk_io_time.read', 'node_disk_read_time_seconds_total'],
+        ['disk_io_time.write', 'node_disk_write_time_seconds_total'],
+        ['disk_merged.read', 'node_disk_reads_merged_total'],
+        ['disk_merged.write', 'node_disk_writes_merged_total'],
+    ]
+    INTERFACE_METRICS = [
+        ['if_octets.rx', 'node_network_receive_bytes_total'],
+        ['if_octets.tx', 'node_network_transmit_bytes_total'],
+        ['if_packets.rx', 'node_network_receive_packets_total'],
+        ['if_packets.tx', 'node_network_transmit_packets_total'],
+        ['if_errors.rx', 'node_network_receive_errs_total'],
+        ['if_errors.tx', 'node_network_transmit_errs_total'],
+        ['if_dropped.rx', 'node_network_receive_drop_total'],
+        ['if_dropped.tx', 'node_network_transmit_drop_total'],
+    ]
+    MEMORY_METRICS = [
+        ['memory-buffered', 'node_memory_Buffers_bytes'],
+        ['memory-cached', 'node_memory_Cached_bytes'],
+        ['memory-free', 'node_memory_MemFree_bytes'],
+        ['memory-total', 'node_memory_MemTotal_bytes'],
+    ]
+
     def __init__(self, url = 'http://localhost:9090/api/v1/query_range',
-                 instances = {}, resultdir = '.', interval = '1m',
-                 startepoch = 0.0):
+                 instances = {}, interval = None, workers = 4,
+                 resolution = 1000, pull_interval = 0, **kwargs):
+        if pull_interval > 0:
+            kwargs['wakeup_interval'] = pull_interval
+        super().__init__(**kwargs)
         self.url = url
         self.instances = instances
-        self.resultdir = resultdir
-        self.startepoch = float(startepoch)
         self.interval = interval
-        self.starttime = time.time()
+        self.workers = workers
+        self.resolution = resolution
+        self.pull_interval = pull_interval
+        self.api = PrometheusAPI(url)
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers = workers)
 
-        self.output = {}
+        # ----
+        # We retrieve the data starting one minute before the run.
+        # ----
+        self.startepoch -= 60
 
-    def run(self):
         # ----
-        # Run until we receive anything on stdin (which is the way the
-        # benchmark driver is signaling us to finish).
+        # In incremental mode the run length isn't known when we start
+        # pulling, so the step is either the configured interval or
+        # the smallest one. The pulled data is appended to the
+        # incremental file, one line per query and pull.
         # ----
-        while True:
-            r, w, x = select.select([sys.stdin], [], [], None)
-            if len(r) > 0:
-                break
+        self.incr_fname = os.path.join(self.resultdir,
+                                       'os-metric.incremental')
+        if self.pull_interval > 0:
+            if self.interval is not None:
+                self.step = mcCollector.parse_duration(self.interval)
+            else:
+                self.step = self.STEPS[0]
+            self.next_start = math.floor(self.startepoch / self.step) * self.step
+            self.incr_fd = open(self.incr_fname, 'w')
 
-    def shutdown(self):
+    def wakeup(self):
         # ----
-        # On shutdown we retrieve the metric data from the
-        # Prometheus server via the api.
-        # ----
-        result = {}
-        for instance in self.instances:
-            print("instance:", instance)
-            iname = instance.split(':')[0]
-            result[iname] = {}
-
-            # ----
-            # Get CPU usage in percent over all CPUs
-            # ----
-            params = {
-                "query": """sum(irate(node_cpu_seconds_total {{instance="{instance}"}}[{interval}])) without (cpu) / count(node_cpu_seconds_total {{instance="{instance}"}}) without (cpu) * 100""".format(instance = instance,
-                                     interval = self.interval),
-                "start": self.startepoch,
-                "end": time.time(),
-                "step": self.interval,
-            }
-            url = self.url + '?' + urllib.parse.urlencode(params)
+        # In incremental mode we wake up every pull_interval to
+        # retrieve the latest data.
+        # ----
+        self.pull(time.time() - self.PULL_LAG)
+
+    def pull(self, end):
+        """
+        Retrieve the data from next_start up to end and append it to
+        the incremental file. The window only moves forward if all
+        queries succeeded, otherwise the next pull tries it again.
+        Returns the number of failed queries.
+        """
+        end = math.floor(end / self.step) * self.step
+        if end < self.next_start:
+            return 0
+        data, failed = self.fetch(self.next_start, end, self.step)
+        for name, qdata in data.items():
+            self.incr_fd.write(json.dumps([name, qdata]) + '\n')
+        self.incr_fd.flush()
+        if failed == 0:
+            self.next_start = end + self.step
+        return failed
+
+    def fetch(self, start, end, step):
+        """
+        Retrieve the data of all queries from start to end. Each query
+        is split into step aligned chunks and all chunks are fetched in
+        parallel. Returns a dict of query name to result data and the
+        number of failed queries, which are missing in the dict.
+        """
+        chunks = self.get_chunks(start, end, step)
+        queries = self.queries(step)
+        futures = [
+            [self.pool.submit(self.api.query_range, query, cstart, cend, step)
+             for cstart, cend in chunks]
+            for name, query, add_func in queries
+        ]
 
+        data = {}
+        failed = 0
+        for (name, query, add_func), qfutures in zip(queries, futures):
             try:
-                with urllib.request.urlopen(url) as fd:
-                    gdata = json.loads(fd.read().decode('utf-8'))
+                data[name] = self.stitch([f.result() for f in qfutures])
             except Exception as ex:
                 print(str(ex), file = sys.stderr)
-                print("url was:", url)
-                return 1
-
-            for entry in gdata['data']['result']:
-                if entry['metric']['mode'] == 'iowait':
-                    metric = "cpu.percent-wait"
-                elif entry['metric']['mode'] == 'irq':
-                    metric = "cpu.percent-interrupt"
-                else:
-                    metric = "cpu.percent-" + entry['metric']['mode']
-                result[iname][metric] = [(ts - self.startepoch, float(v)) for ts, v in entry['values']]
-
-            # ----
-            # Get the disk metric data
-            # ----
-            metric_map = [
-                ['disk_octets.read', 'node_disk_read_bytes_total'],
-                ['disk_octets.write', 'node_disk_written_bytes_total'],
-                ['disk_ops.read', 'node_disk_reads_completed_total'],
-                ['disk_ops.write', 'node_disk_writes_completed_total'],
-                ['disk_io_time.read', 'node_disk_read_time_seconds_total'],
-                ['disk_io_time.write', 'node_disk_write_time_seconds_total'],
-                ['disk_merged.read', 'node_disk_reads_merged_total'],
-                ['disk_merged.write', 'node_disk_writes_merged_total'],
-            ]
-            for ment in metric_map:
-                params = {
-                    "query": """irate({metric} {{instance="{instance}"}} [{interval}])""".format(
-                            metric = ment[1],
-                            instance = instance,
-                            interval = self.interval,
-                        ),
-                    "start": self.startepoch,
-                    "end": time.time(),
-                    "step": self.interval,
-                }
-                url = self.url + '?' + urllib.parse.urlencode(params)
-
-                try:
-                    with urllib.request.urlopen(url) as fd:
-                        gdata = json.loads(fd.read().decode('utf-8'))
-                except Exception as ex:
-                    print(str(ex), file = sys.stderr)
-                    print("url was:", url)
-                    return 1
-
-                for entry in gdata['data']['result']:
-                    dev = entry['metric']['device']
-                    mname = 'disk-' + dev + '.' + ment[0]
-                    result[iname][mname] = [(ts - self.startepoch, float(v)) for ts, v in entry['values']]
-
-            # ----
-            # Get the network interface metric data
-            # ----
-            metric_map = [
-                ['if_octets.rx', 'node_network_receive_bytes_total'],
-                ['if_octets.tx', 'node_network_transmit_bytes_total'],
-                ['if_packets.rx', 'node_network_receive_packets_total'],
-                ['if_packets.tx', 'node_network_transmit_packets_total'],
-                ['if_errors.rx', 'node_network_receive_errs_total'],
-                ['if_errors.tx', 'node_network_transmit_errs_total'],
-                ['if_dropped.rx', 'node_network_receive_drop_total'],
-                ['if_dropped.tx', 'node_network_transmit_drop_total'],
-            ]
-            for ment in metric_map:
-                params = {
-                    "query": """irate({metric} {{instance="{instance}"}} [{interval}])""".format(
-                            metric = ment[1],
-                            instance = instance,
-                            interval = self.interval,
-                        ),
-                    "start": self.startepoch,
-                    "end": time.time(),
-                    "step": self.interval,
-                }
-                url = self.url + '?' + urllib.parse.urlencode(params)
-
-                try:
-                    with urllib.request.urlopen(url) as fd:
-                        gdata = json.loads(fd.read().decode('utf-8'))
-                except Exception as ex:
-                    print(str(ex), file = sys.stderr)
-                    print("url was:", url)
-                    return 1
-
-                for entry in gdata['data']['result']:
-                    dev = entry['metric']['device']
-                    mname = 'interface-' + dev + '.' + ment[0]
-                    result[iname][mname] = [(ts - self.startepoch, float(v)) for ts, v in entry['values']]
-
-            # ----
-            # Get the memory metric data
-            # ----
-            metric_map = [
-                ['memory-used', 'special'],
-                ['memory-buffered', 'node_memory_Buffers_bytes'],
-                ['memory-cached', 'node_memory_Cached_bytes'],
-                ['memory-free', 'node_memory_MemFree_bytes'],
-            ]
-            for ment in metric_map:
-                params = {
-                    "query": """{metric} {{instance="{instance}"}}""".format(
-                            metric = ment[1],
-                            instance = instance,
-                            interval = self.interval,
-                        ),
-                    "start": self.startepoch,
-                    "end": time.time(),
-                    "step": self.interval,
-                }
-                if ment[0] == 'memory-used':
-                    params['query'] = """node_memory_MemTotal_bytes {{instance="{instance}"}} - node_memory_MemFree_bytes {{instance="{instance}"}}""".format(
-                            instance = instance,
-                        )
-                url = self.url + '?' + urllib.parse.urlencode(params)
-
-                try:
-                    with urllib.request.urlopen(url) as fd:
-                        gdata = json.loads(fd.read().decode('utf-8'))
-                except Exception as ex:
-                    print(str(ex), file = sys.stderr)
-                    print("url was:", url)
-                    return 1
-
-                mname = 'memory.' + ment[0]
-                result[iname][mname] = [(ts - self.startepoch, float(v)) for ts, v in gdata['data']['result'][0]['values']]
-
-        with open(os.path.join(self.resultdir, 'os-metric.json'), 'w') as fd:
-            fd.write(json.dumps(result))
+                failed += 1
+        return data, failed
+
+    def load_incremental(self):
+        """
+        Read the incremental file back into a dict of query name to
+        result data.
+        """
+        pulls = {}
+        with open(self.incr_fname, 'r') as fd:
+            for line in fd:
+                name, qdata = json.loads(line)
+                pulls.setdefault(name, []).append(qdata)
+        return {name: self.stitch(qpulls) for name, qpulls in pulls.items()}
+
+    def finish(self):
+        # ----
+        # On shutdown we retrieve the metric data from the
+        # Prometheus server via the api. A failed query is reported,
+        # but we still save everything else we got. In incremental
+        # mode only what was not pulled yet needs to be retrieved.
+        # ----
+        end = time.time()
+        if self.pull_interval > 0:
+            step = self.step
+            failed = self.pull(end)
+            self.incr_fd.close()
+            data = self.load_incremental()
+        else:
+            step = self.get_step(end)
+            data, failed = self.fetch(self.startepoch, end, step)
+        self.pool.shutdown()
+
+        result = {instance.split(':')[0]: {} for instance in self.instances}
+        for name, query, add_func in self.queries(step):
+            if name in data:
+                add_func(data[name], result)
+
+        self.save(result)
+        if self.pull_interval > 0:
+            os.remove(self.incr_fname)
+        return failed
+
+    def get_step(self, end):
+        """
+        Return the query step in seconds.
+        """
+        if self.interval is not None:
+            return mcCollector.parse_duration(self.interval)
+        want = (end - self.startepoch) / self.resolution
+        for step in self.STEPS:
+            if step >= want:
+                return step
+        return math.ceil(want / self.STEPS[-1]) * self.STEPS[-1]
+
+    def get_chunks(self, start, end, step):
+        """
+        Split the time from start to end into (start, end) chunks
+        of at most CHUNK_POINTS steps. All chunks start at a multiple
+        of the step, so the timestamps of all chunks and all queries
+        line up and consecutive chunks never overlap.
+        """
+        start = math.floor(start / step) * step
+        size = self.CHUNK_POINTS * step
+        chunks = []
+        while start <= end:
+            chunks.append((start, min(start + size - step, end)))
+            start += size
+        return chunks
+
+    def stitch(self, chunk_results):
+        """
+        Combine the results of the chunks (or pulls) of one query into
+        one result with one entry per series. Timestamps that appear in
+        more than one chunk are only used once.
+        """
+        series = {}
+        for data in chunk_results:
+            for entry in data:
+                key = tuple(sorted(entry['metric'].items()))
+                if key not in series:
+                    series[key] = {'metric': entry['metric'], 'values': {}}
+                series[key]['values'].update(
+                        (ts, v) for ts, v in entry['values'])
+        return [{'metric': s['metric'], 'values': sorted(s['values'].items())}
+                for s in series.values()]
+
+    def queries(self, step):
+        """
+        Return a list of (name, query, add_func) tuples, where add_func
+        adds the series of the query result to the result dict.
+        """
+        select = 'instance=~"{}"'.format(self._instance_regex())
+        rate_range = "{}s".format(int(max(step, self.RATE_RANGE)))
+
+        # ----
+        # CPU usage in percent over all CPUs
+        # ----
+        cpu = """sum(irate(node_cpu_seconds_total {{{select}}}[{rate_range}])) without (cpu) / count(node_cpu_seconds_total {{{select}}}) without (cpu) * 100""".format(
+                select = select, rate_range = rate_range)
+
+        # ----
+        # The disk and interface rates are each fetched with one
+        # query. Since irate() drops the metric name, every part gets
+        # a bmsql_metric label with the name we want in the output.
+        # ----
+        disk = self._rate_query(self.DISK_METRICS, select, rate_range)
+        interface = self._rate_query(self.INTERFACE_METRICS, select,
+                                     rate_range)
+
+        # ----
+        # The memory gauges keep their name, so a regex on __name__
+        # gets all of them at once.
+        # ----
+        memory = """{{__name__=~"{names}", {select}}}""".format(
+                names = '|'.join([m[1] for m in self.MEMORY_METRICS]),
+                select = select)
+
+        return [
+            ('cpu', cpu, self._add_cpu),
+            ('disk', disk, lambda data, result: self._add_device(data, result, 'disk-')),
+            ('interface', interface, lambda data, result: self._add_device(data, result, 'interface-')),
+            ('memory', memory, self._add_memory),
+        ]
+
+    def _instance_regex(self):
+        # ----
+        # Escape the regex metacharacters for RE2 and then the
+        # backslashes for the PromQL string literal.
+        # ----
+        regex = '|'.join([re.escape(instance) for instance in self.instances])
+        return regex.replace('\\', '\\\\')
+
+    def _rate_query(self, metric_map, select, rate_range):
+        return ' or '.join(["""label_replace(irate({metric} {{{select}}}[{rate_range}]), "bmsql_metric", "{name}", "", "")""".format(
+                metric = ment[1], select = select,
+                rate_range = rate_range, name = ment[0])
+                for ment in metric_map])
+
+    def _values(self, entry):
+        return [(ts - self.startepoch, float(v)) for ts, v in entry['values']]
+
+    def _host(self, entry, result):
+        return result.setdefault(entry['metric']['instance'].split(':')[0], {})
+
+    def _add_cpu(self, data, result):
+        for entry in data:
+            if entry['metric']['mode'] == 'iowait':
+                metric = "cpu.percent-wait"
+            elif entry['metric']['mode'] == 'irq':
+                metric = "cpu.percent-interrupt"
+            else:
+                metric = "cpu.percent-" + entry['metric']['mode']
+            self._host(entry, result)[metric] = self._values(entry)
+
+    def _add_device(self, data, result, prefix):
+        for entry in data:
+            dev = entry['metric']['device']
+            mname = prefix + dev + '.' + entry['metric']['bmsql_metric']
+            self._host(entry, result)[mname] = self._values(entry)
+
+    def _add_memory(self, data, result):
+        names = {m[1]: m[0] for m in self.MEMORY_METRICS}
+        series = {}
+        for entry in data:
+            host = self._host(entry, result)
+            mname = names[entry['metric']['__name__']]
+            series[(id(host), mname)] = dict(entry['values'])
+            if mname != 'memory-total':
+                host['memory.' + mname] = self._values(entry)
+
+        # ----
+        # memory-used is MemTotal - MemFree at every step that has both.
+        # ----
+        for entry in data:
+            if entry['metric']['__name__'] != 'node_memory_MemTotal_bytes':
+                continue
+            host = self._host(entry, result)
+            free = series.get((id(host), 'memory-free'), {})
+            host['memory.memory-used'] = [
+                    (ts - self.startepoch, float(v) - float(free[ts]))
+                    for ts, v in entry['values'] if ts in free]
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())